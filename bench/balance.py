@@ -0,0 +1,116 @@
+# bench/balance.py
+"""Vérifications de propriétés + mesure du répartiteur d'équipes (balance_teams).
+
+    python bench/balance.py            # propriétés sur 500 lobbies aléatoires + temps
+    python bench/balance.py -n 2000    # plus de lobbies
+
+Propriétés vérifiées :
+- équipes de taille n//2 et n - n//2, chaque joueur exactement une fois (exact et heuristique)
+- exact == optimum d'une force brute sur toutes les partitions (team_cost, premades respectés)
+- premades jamais séparés quand une répartition les respectant existe
+- premade plus gros qu'une équipe (ou tailles incompatibles) : équipes toujours complètes,
+  seul le premade libéré est séparé, les autres restent groupés
+Sort avec un code non nul au premier échec.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import itertools
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bot  # noqa: E402
+
+def brute_force(values, groups):
+    """Meilleur coût sur toutes les partitions de taille n//2 qui ne coupent aucun premade (None si aucune)."""
+    ids = list(values)
+    half = len(ids) // 2
+    best = None
+    for a in itertools.combinations(ids, half):
+        sa = set(a)
+        if any(0 < len(sa & set(g)) < len(g) for g in groups):
+            continue
+        cost = bot.team_cost(values, a, [x for x in ids if x not in sa])
+        if best is None or cost < best:
+            best = cost
+    return best
+
+def random_lobby(rnd: random.Random, n: int, max_group: int = 3):
+    values = {uid: rnd.randint(1, 27) * 100 for uid in range(1, n + 1)}
+    ids = list(values); rnd.shuffle(ids)
+    groups, k = [], 0
+    while k < n and rnd.random() < 0.5:
+        size = rnd.randint(2, max_group)
+        g = ids[k:k + size]
+        if len(g) >= 2:
+            groups.append(g)
+        k += size
+    return values, groups
+
+def check_shape(values, a, b, label):
+    n = len(values)
+    assert sorted((len(a), len(b))) == sorted((n // 2, n - n // 2)), f"{label}: tailles {len(a)}/{len(b)}"
+    assert sorted(a + b) == sorted(values), f"{label}: joueurs perdus ou dupliqués"
+
+def together(groups, a, b) -> bool:
+    sa = set(a)
+    return all(set(g) <= sa or not (set(g) & sa) for g in groups)
+
+def check_properties(lobbies: int, seed: int):
+    rnd = random.Random(seed)
+    for k in range(lobbies):
+        n = rnd.choice((10, 10, 10, 8, 6, 9))
+        values, groups = random_lobby(rnd, n)
+        a, b = bot.balance_exact(values, groups)
+        check_shape(values, a, b, f"exact #{k}")
+        ref = brute_force(values, groups)
+        if ref is not None:
+            assert together(groups, a, b), f"exact #{k}: premade séparé alors qu'évitable {groups}"
+            assert bot.team_cost(values, a, b) == ref, f"exact #{k}: {bot.team_cost(values, a, b)} != optimum {ref}"
+        ha, hb = bot.balance_heuristic(values, groups)
+        check_shape(values, ha, hb, f"heuristique #{k}")
+        if ref is not None:
+            assert together(groups, ha, hb), f"heuristique #{k}: premade séparé {groups}"
+    print(f"propriétés OK sur {lobbies} lobbies (exact == force brute, tailles, premades)")
+
+def check_oversized():
+    values = {u: 100 * u for u in range(1, 11)}
+    cases = [
+        ([[1, 2, 3, 4, 5, 6]], []),                      # premade de 6 en 5v5 : forcément séparé
+        ([[1, 2, 3, 4, 5, 6, 7], [8, 9]], [[8, 9]]),      # le petit premade doit rester groupé
+        ([[1, 2, 3], [4, 5, 6], [7, 8, 9]], None),        # 3+3+3+1 : aucune répartition 5/5 possible
+    ]
+    for groups, kept in cases:
+        for fn in (bot.balance_exact, bot.balance_heuristic, bot.balance_teams):
+            a, b = fn(values, groups)
+            check_shape(values, a, b, f"{fn.__name__} {groups}")
+            if kept is not None:
+                assert together(kept, a, b), f"{fn.__name__} {groups}: {kept} séparé"
+        a, b = bot.balance_exact(values, groups)
+        if kept is not None:
+            ref = brute_force(values, kept)
+            assert bot.team_cost(values, a, b) == ref, f"exact {groups}: pas optimal une fois le gros premade libéré"
+    print("premades trop gros OK (équipes complètes, autres premades conservés)")
+
+def timings(seed: int):
+    rnd = random.Random(seed)
+    for n, label in ((10, "5v5 exact"), (14, "7v7 exact"), (20, "10v10 heuristique"), (40, "20v20 heuristique")):
+        lobbies = [random_lobby(rnd, n) for _ in range(50)]
+        t0 = time.perf_counter()
+        for values, groups in lobbies:
+            bot.balance_teams(values, groups)
+        dt = (time.perf_counter() - t0) / len(lobbies)
+        print(f"{label:>20} : {dt * 1000:7.2f} ms / répartition")
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("-n", type=int, default=500, help="nombre de lobbies aléatoires")
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+    check_properties(args.n, args.seed)
+    check_oversized()
+    timings(args.seed)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+# bench/captcha_warp.py
+"""Micro-benchmark de la déformation du captcha : _warp (gather précalculé) contre l'ancienne boucle pixel par pixel.
+
+    python bench/captcha_warp.py              # 50 images 280x110
+    python bench/captcha_warp.py -n 200
+
+Vérifie d'abord que les deux rendus sont identiques octet pour octet, puis affiche le temps par image
+(premier appel de _warp compris à part : il construit le champ de déplacement mis en cache).
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bot  # noqa: E402
+
+W, H = 280, 110
+
+def warp_per_pixel(img: Image.Image) -> Image.Image:
+    """Implémentation d'origine de build_captcha_image (un _distort et deux accès PixelAccess par pixel)."""
+    w, h = img.size
+    dist = Image.new("RGB", (w, h), (28, 28, 30))
+    src, dst = img.load(), dist.load()
+    for yy in range(h):
+        for xx in range(w):
+            sx, sy = bot._distort(xx, yy, w, h)
+            sx = min(max(sx, 0), w - 1); sy = min(max(sy, 0), h - 1)
+            dst[xx, yy] = src[sx, sy]
+    return dist
+
+def random_image(rnd: random.Random) -> Image.Image:
+    return Image.frombytes("RGB", (W, H), bytes(rnd.getrandbits(8) for _ in range(W * H * 3)))
+
+def per_image(fn, images) -> float:
+    t0 = time.perf_counter()
+    for img in images:
+        fn(img)
+    return (time.perf_counter() - t0) / len(images)
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("-n", type=int, default=50, help="nombre d'images")
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+    rnd = random.Random(args.seed)
+    images = [random_image(rnd) for _ in range(args.n)]
+
+    bot._warp_map.cache_clear()
+    t0 = time.perf_counter()
+    first = bot._warp(images[0])
+    cold = time.perf_counter() - t0
+    for img in images[:10]:
+        assert bot._warp(img).tobytes() == warp_per_pixel(img).tobytes(), "_warp diffère de la boucle d'origine"
+    assert first.tobytes() == warp_per_pixel(images[0]).tobytes()
+    print(f"rendus identiques sur {min(10, args.n)} images {W}x{H}")
+
+    old = per_image(warp_per_pixel, images)
+    new = per_image(bot._warp, images)
+    print(f"boucle pixel par pixel : {old * 1000:7.2f} ms / image")
+    print(f"_warp (gather)         : {new * 1000:7.2f} ms / image   x{old / new:,.0f}  "
+          f"(premier appel, champ compris : {cold * 1000:.1f} ms)")
+    full = per_image(lambda _: bot.build_captcha_image("ABC123"), images[:20])
+    print(f"build_captcha_image    : {full * 1000:7.2f} ms / image")
+
+if __name__ == "__main__":
+    main()
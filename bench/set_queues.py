@@ -0,0 +1,65 @@
+# bench/set_queues.py
+"""Micro-benchmark des files 5v5 : SetQueues (OrderedDict + index inverse) contre l'ancienne file en liste.
+
+    python bench/set_queues.py                 # N = 1000, 5000, 20000
+    python bench/set_queues.py -n 50000
+
+Scénario par N : N entrées, N entrées en double (refusées), N/2 sorties, 50 lectures de la file
+(rendu du panneau), puis vidage par pop10. La persistance est neutralisée : on mesure la structure.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+from typing import Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bot  # noqa: E402
+
+bot.persist_queue = lambda i: None
+
+class ListQueues:
+    """Implémentation d'origine : une liste par set (appartenance / retrait en O(n))."""
+    def __init__(self): self.queues: Dict[int, List[int]] = {1: []}
+    def join(self, i, uid):
+        q = self.queues[i]
+        if uid in q: return False
+        q.append(uid); return True
+    def leave(self, i, uid):
+        q = self.queues[i]
+        if uid not in q: return False
+        q.remove(uid); return True
+    def size(self, i): return len(self.queues[i])
+    def pop10(self, i):
+        q = self.queues[i]; p = q[:10]; self.queues[i] = q[10:]; return p
+    def list(self, i): return list(self.queues[i])
+
+def scenario(queues, n: int, seed: int = 1) -> float:
+    rnd = random.Random(seed)
+    uids = rnd.sample(range(10**6, 10**7), n)
+    leaving = rnd.sample(uids, n // 2)
+    t0 = time.perf_counter()
+    for u in uids: queues.join(1, u)
+    for u in uids: queues.join(1, u)
+    for u in leaving: queues.leave(1, u)
+    for _ in range(50): sum(1 for _ in queues.list(1))
+    while queues.size(1): queues.pop10(1)
+    return time.perf_counter() - t0
+
+def fmt(dt: float) -> str:
+    return f"{dt:.1f} s" if dt >= 1 else f"{dt * 1000:.1f} ms"
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("-n", type=int, action="append", help="taille(s) de file (répétable)")
+    args = ap.parse_args()
+    for n in args.n or (1000, 5000, 20000):
+        old = scenario(ListQueues(), n)
+        new = scenario(bot.SetQueues(), n)
+        print(f"N={n:<7} liste {fmt(old):>9}   SetQueues {fmt(new):>9}   x{old / new:,.0f}")
+    sq = bot.SetQueues()
+    assert len(sq.list(42)) == 0 and 42 not in sq.queues, "list() ne doit pas créer de file"
+
+if __name__ == "__main__":
+    main()
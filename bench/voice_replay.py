@@ -0,0 +1,131 @@
+# bench/voice_replay.py
+"""Rejoue un flux d'événements vocaux dans on_voice_state_update et mesure le débit (événements/s).
+
+    python bench/voice_replay.py                         # flux synthétique (profil d'une soirée chargée)
+    python bench/voice_replay.py --record flux.jsonl     # enregistre le flux synthétique
+    python bench/voice_replay.py --stream flux.jsonl     # rejoue un flux enregistré
+
+Format d'un flux : une ligne JSON par événement, {"member": id, "before": salon|null, "after": salon|null}.
+Les salons 1 = « Créer un salon », 100.. = salons ordinaires, 1000.. = salons temporaires.
+Les objets Discord sont des bouchons : aucun appel réseau, on mesure le coût du handler lui-même.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+from types import SimpleNamespace as NS
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bot  # noqa: E402
+
+CREATOR_ID   = 1
+PLAIN_IDS    = range(100, 140)
+TEMP_IDS     = range(1000, 1200)
+
+class Channel:
+    def __init__(self, cid: int, name: str):
+        self.id, self.name, self.members, self.category = cid, name, [object()], None
+        self.overwrites = {}
+    def __eq__(self, other): return other is not None and getattr(other, "id", None) == self.id
+    def __hash__(self): return self.id
+    async def send(self, *a, **k): pass
+    async def edit(self, **k): return self
+    async def delete(self, **k): pass
+
+class Guild:
+    def __init__(self):
+        self.id = 1
+        self.channels = {CREATOR_ID: Channel(CREATOR_ID, bot.CREATE_VOICE_NAME)}
+        self.channels.update({i: Channel(i, f"Salon {i}") for i in PLAIN_IDS})
+        self.channels.update({i: Channel(i, f"{bot.TEMP_VOICE_PREFIX}{i}") for i in TEMP_IDS})
+        self.voice_channels = list(self.channels.values())
+        self.categories, self.text_channels = [], []
+        self.default_role, self.me = NS(id=1), NS(id=2)
+        self._next = 10_000
+    def get_channel(self, cid): return self.channels.get(cid)
+    def get_member(self, uid): return None
+    async def create_voice_channel(self, name, **k):
+        self._next += 1
+        ch = self.channels[self._next] = Channel(self._next, name)
+        return ch
+    create_text_channel = create_voice_channel
+
+class Member:
+    def __init__(self, uid: int, guild: Guild):
+        self.id, self.guild = uid, guild
+        self.name = self.display_name = f"m{uid}"
+        self.mention = f"<@{uid}>"
+    @property
+    def guild_permissions(self):
+        # discord.py recalcule les permissions à chaque accès (parcours des rôles)
+        return NS(administrator=False)
+    async def move_to(self, channel, **k): pass
+
+def synthetic_stream(n: int, seed: int = 1):
+    """Profil observé : ~85 % mute/sourdine/stream, ~12 % déplacements, ~3 % entrées en salon temporaire."""
+    rnd = random.Random(seed)
+    plain, temps = list(PLAIN_IDS), list(TEMP_IDS)
+    for _ in range(n):
+        uid, r = rnd.randrange(2000), rnd.random()
+        if r < 0.85:
+            c = rnd.choice(plain + temps[:20])
+            yield {"member": uid, "before": c, "after": c}
+        elif r < 0.97:
+            yield {"member": uid, "before": rnd.choice(plain), "after": rnd.choice(plain + [None])}
+        elif r < 0.999:
+            yield {"member": uid, "before": rnd.choice(plain), "after": rnd.choice(temps)}
+        else:
+            yield {"member": uid, "before": None, "after": CREATOR_ID}
+
+def setup_rooms(guild: Guild):
+    for vid in TEMP_IDS:
+        bot.temp_rooms[vid] = bot.TempRoom(owner_id=vid, voice_id=vid, text_id=0,
+                                           private=bool(vid % 2), whitelist=set(range(50)))
+    bot.persist_room = lambda room: None   # pas de SQLite dans la mesure
+
+async def replay(events, guild: Guild) -> float:
+    members = {}
+    chan = guild.get_channel
+    prepared = []
+    for ev in events:
+        m = members.get(ev["member"]) or members.setdefault(ev["member"], Member(ev["member"], guild))
+        prepared.append((m, NS(channel=chan(ev["before"]) if ev["before"] else None),
+                            NS(channel=chan(ev["after"]) if ev["after"] else None)))
+    handler = bot.on_voice_state_update
+    t0 = time.perf_counter()
+    for m, before, after in prepared:
+        await handler(m, before, after)
+    return len(prepared) / (time.perf_counter() - t0)
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--stream", help="flux JSONL enregistré à rejouer")
+    ap.add_argument("--record", help="écrit le flux synthétique dans ce fichier et s'arrête")
+    ap.add_argument("-n", type=int, default=200_000, help="taille du flux synthétique")
+    ap.add_argument("--rounds", type=int, default=3)
+    args = ap.parse_args()
+
+    if args.record:
+        with open(args.record, "w") as f:
+            for ev in synthetic_stream(args.n):
+                f.write(json.dumps(ev) + "\n")
+        return
+    if args.stream:
+        with open(args.stream) as f:
+            events = [json.loads(line) for line in f if line.strip()]
+    else:
+        events = list(synthetic_stream(args.n))
+
+    async def run():
+        guild = Guild()
+        bot.channel_index(guild)   # index créateur par ID
+        setup_rooms(guild)
+        rates = [await replay(events, guild) for _ in range(args.rounds)]
+        print(f"{len(events):,} événements, meilleur de {args.rounds} : {max(rates):,.0f} événements/s")
+    asyncio.run(run())
+
+if __name__ == "__main__":
+    main()
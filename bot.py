@@ -8,14 +8,27 @@ import hmac
 import hashlib
 import random
 import asyncio
-from dataclasses import dataclass, field
-from typing import List, Dict, Optional, Tuple, Set
+import json
+import sqlite3
+import operator
+import heapq
+import itertools
+import datetime
+import urllib.parse
+from dataclasses import dataclass, field, asdict
+from functools import lru_cache
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Tuple, Set, Iterable, Callable, Awaitable, Any
 
 import discord
 from discord import app_commands
 from discord.ext import commands
 from dotenv import load_dotenv
-from PIL import Image, ImageDraw, ImageFont, ImageFilter
+from PIL import Image, ImageDraw, ImageFont, ImageFilter, ImageOps
+
+import metrics
+from keep_alive import keep_alive
 
 # ===================== Config =====================
 load_dotenv()
@@ -30,13 +43,17 @@ INTENTS.messages = True
 INTENTS.message_content = False
 
 # Parties perso
-PREP_PAIRS        = 4
+PREP_SETS_MIN     = int(os.getenv("PREP_SETS_MIN", "4"))    # sets toujours présents
+PREP_SETS_MAX     = int(os.getenv("PREP_SETS_MAX", "16"))   # plafond (soirées événement)
+SET_IDLE_TEARDOWN_S = 15 * 60   # set au-delà du minimum supprimé après ce délai d'inactivité
 PREP_VOICE_LIMIT  = 10
 SIDE_VOICE_LIMIT  = 5
 
 # Créateur de salon vocal
 CREATE_VOICE_NAME    = "➕ Créer un salon"
 TEMP_DELETE_GRACE_S  = 60  # secondes après salon vide avant suppression
+TEMP_DELETE_RETRY_S  = 30  # nouvel essai après une suppression refusée (403, 5xx, rate limit)
+TEMP_ROOM_POOL_SIZE  = int(os.getenv("TEMP_ROOM_POOL_SIZE", "0"))  # salons vocaux cachés pré-créés (0 = désactivé)
 
 # DA / Noms de catégories
 SERVER_BRAND_NAME = os.getenv("SERVER_BRAND_NAME", "Arène de Kaer Morhen")
@@ -75,6 +92,74 @@ PP_TEXT = [
     ("🧭・demande-orga-pp", "text"),
 ]
 
+# ===================== Persistance (SQLite WAL) =====================
+STATE_DB_PATH  = os.getenv("STATE_DB_PATH", "state.db")
+STATE_FLUSH_S  = 1.0   # intervalle d'écriture différée
+
+class StateStore:
+    """Clé -> JSON dans SQLite (WAL). Écritures différées et groupées : les handlers ne touchent jamais le disque."""
+    def __init__(self, path: str):
+        self.path = path
+        self.db: Optional[sqlite3.Connection] = None
+        self.pending: Dict[str, Any] = {}   # clé -> valeur à sérialiser (None = suppression)
+        # Un seul thread possède la connexion
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state")
+
+    def _open(self) -> Dict[str, str]:
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        db.commit()
+        self.db = db
+        return dict(db.execute("SELECT key, value FROM state"))
+
+    async def load(self) -> Dict[str, Any]:
+        """Ouvre la base et charge tout l'état en une requête."""
+        rows = await asyncio.get_running_loop().run_in_executor(self.executor, self._open)
+        return {k: json.loads(v) for k, v in rows.items()}
+
+    def put(self, key: str, value: Any):
+        """La sérialisation est faite au flush : N modifications d'une même clé = un seul dump."""
+        self.pending[key] = value
+
+    def delete(self, key: str):
+        self.pending[key] = None
+
+    def _write(self, batch: Dict[str, Optional[str]]):
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)",
+                                [(k, v) for k, v in batch.items() if v is not None])
+            self.db.executemany("DELETE FROM state WHERE key = ?",
+                                [(k,) for k, v in batch.items() if v is None])
+
+    async def flush(self):
+        if not self.pending or self.db is None:
+            return
+        pending, self.pending = self.pending, {}
+        try:
+            batch = {k: (None if v is None else json.dumps(v, default=list)) for k, v in pending.items()}
+            await asyncio.get_running_loop().run_in_executor(self.executor, self._write, batch)
+        except BaseException:
+            # Lot remis en attente pour le prochain flush ; les valeurs posées entre-temps sont plus récentes
+            pending.update(self.pending)
+            self.pending = pending
+            raise
+
+    async def flusher(self, every: float):
+        while True:
+            await asyncio.sleep(every)
+            try: await self.flush()
+            except Exception: metrics.swallowed()
+
+    async def close(self):
+        await self.flush()
+        if self.db is not None:
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.db.close)
+            self.db = None
+
+state_store = StateStore(STATE_DB_PATH)
+
 # ===================== Helpers texte & catégories =====================
 ATTACK_KEYWORDS  = {"attaque", "att", "atk"}
 DEFENSE_KEYWORDS = {"défense", "defense", "def"}
@@ -92,61 +177,131 @@ def has_defense(name: str) -> bool:
     n = slug(name)
     return any(k in n for k in DEFENSE_KEYWORDS)
 
+class ChannelIndex:
+    """Index des salons d'une guilde, construit à la demande et invalidé par les events de salons.
+
+    - catégories par nom, recherches (catégorie, slug) -> salon texte (résultats négatifs compris)
+    - set i -> (Préparation i, Attaque, Défense), calculé en une passe sur la catégorie PP
+    - ID du salon « Créer un salon » (filtre rapide de on_voice_state_update)
+    - IDs des salons-partie (filtre rapide de on_message)
+    On stocke des IDs : la résolution passe par guild.get_channel (O(1)) et ne garde aucun objet périmé.
+    """
+    def __init__(self):
+        self.cats: Dict[str, int] = {}
+        self.lookups: Dict[Tuple[int, str], Optional[int]] = {}
+        self.sets: Optional[Dict[int, Tuple[Optional[int], Optional[int], Optional[int]]]] = None
+        self.creator: Optional[int] = -1   # -1 = pas encore cherché, None = absent
+        self.party: Optional[Set[int]] = None
+
+    def category(self, guild: discord.Guild, name: str) -> Optional[discord.CategoryChannel]:
+        cid = self.cats.get(name)
+        cat = guild.get_channel(cid) if cid else None
+        if cat is None or cat.name != name:
+            cat = discord.utils.get(guild.categories, name=name)
+            if cat is None:
+                self.cats.pop(name, None)
+                return None
+            self.cats[name] = cat.id
+        return cat
+
+    def text_by_slug(self, cat: discord.CategoryChannel, target: str) -> Optional[discord.TextChannel]:
+        key = (cat.id, target.lower())
+        if key in self.lookups:
+            cid = self.lookups[key]
+            ch = cat.guild.get_channel(cid) if cid else None
+            if cid is None or ch is not None:
+                return ch
+        # Mots entiers : "salon partie 1" ne doit pas matcher "salon partie 10"
+        words = re.compile(rf"(?:^|\s){re.escape(key[1])}(?:\s|$)")
+        ch = next((c for c in getattr(cat, "text_channels", []) if words.search(slug(c.name))), None)
+        self.lookups[key] = ch.id if ch else None
+        return ch
+
+    def _build_sets(self, guild: discord.Guild):
+        if self.sets is None:
+            self.sets = {}
+            cat = self.category(guild, CAT_PP_NAME)
+            cur = None
+            for vc in sorted(cat.voice_channels, key=lambda c: c.position) if cat else []:
+                n = slug(vc.name)
+                if n.startswith("préparation "):
+                    num = n[len("préparation "):]
+                    cur = int(num) if num.isdigit() else None
+                    if cur is not None and cur not in self.sets:
+                        self.sets[cur] = (vc.id, None, None)
+                    continue
+                if cur is None: continue
+                prep, atk, defn = self.sets[cur]
+                if atk is None and has_attack(vc.name): atk = vc.id
+                if defn is None and has_defense(vc.name): defn = vc.id
+                self.sets[cur] = (prep, atk, defn)
+        return self.sets
+
+    def set_numbers(self, guild: discord.Guild) -> List[int]:
+        return sorted(self._build_sets(guild))
+
+    def group(self, guild: discord.Guild, i: int):
+        ids = self._build_sets(guild).get(i)
+        if not ids: return None, None, None
+        return tuple(guild.get_channel(c) if c else None for c in ids)
+
+    def creator_id(self, guild: discord.Guild) -> Optional[int]:
+        if self.creator == -1:
+            vc = discord.utils.get(guild.voice_channels, name=CREATE_VOICE_NAME)
+            self.creator = vc.id if vc else None
+        return self.creator
+
+    def party_ids(self, guild: discord.Guild) -> Set[int]:
+        if self.party is None:
+            self.party = {ch.id for ch in (get_party_text_channel(guild, i) for i in self.set_numbers(guild)) if ch}
+        return self.party
+
+    def invalidate(self, channel: discord.abc.GuildChannel):
+        self.party = None
+        if isinstance(channel, discord.CategoryChannel):
+            self.cats = {k: v for k, v in self.cats.items() if v != channel.id}
+            self.lookups = {k: v for k, v in self.lookups.items() if k[0] != channel.id}
+            self.sets = None
+            return
+        cat_id = getattr(channel, "category_id", None)
+        self.lookups = {k: v for k, v in self.lookups.items() if k[0] != cat_id and v != channel.id}
+        if isinstance(channel, discord.VoiceChannel):
+            self.sets = None
+            self.creator = -1
+
+_channel_indexes: Dict[int, ChannelIndex] = {}
+
+def channel_index(guild: discord.Guild) -> ChannelIndex:
+    idx = _channel_indexes.get(guild.id)
+    if idx is None:
+        idx = _channel_indexes[guild.id] = ChannelIndex()
+    return idx
+
+def category_by_name(guild: discord.Guild, name: str) -> Optional[discord.CategoryChannel]:
+    return channel_index(guild).category(guild, name)
+
 def find_text_by_slug(cat: discord.CategoryChannel, target: str) -> Optional[discord.TextChannel]:
-    t = target.lower()
-    for ch in getattr(cat, "text_channels", []):
-        if t in slug(ch.name):
-            return ch
-    return None
+    return channel_index(cat.guild).text_by_slug(cat, target)
 
 def pp_category(guild: discord.Guild) -> Optional[discord.CategoryChannel]:
-    return discord.utils.get(guild.categories, name=CAT_PP_NAME)
+    return category_by_name(guild, CAT_PP_NAME)
 
 def commu_category(guild: discord.Guild) -> Optional[discord.CategoryChannel]:
-    return discord.utils.get(guild.categories, name=CAT_COMMU_NAME)
-
-async def create_category_with_channels(guild: discord.Guild, name: str, items: List[tuple]) -> discord.CategoryChannel:
-    cat = discord.utils.get(guild.categories, name=name)
-    if cat is None:
-        cat = await guild.create_category(name, reason="Setup bot")
-    exist_text = {c.name for c in cat.text_channels}
-    exist_voice = {c.name for c in cat.voice_channels}
-    for nm, kind in items:
-        if kind == "text" and nm not in exist_text:
-            await guild.create_text_channel(nm, category=cat)
-        elif kind == "voice" and nm not in exist_voice:
-            await guild.create_voice_channel(nm, category=cat)
-    return cat
-
-async def ensure_party_text_channels(guild: discord.Guild, cat: discord.CategoryChannel, count: int = 4):
-    existing = {slug(c.name): c for c in cat.text_channels}
-    for i in range(1, count+1):
-        s = f"salon partie {i}"
-        if s not in existing:
-            await guild.create_text_channel(f"• salon-partie-{i}", category=cat, reason="PP party chat")
+    return category_by_name(guild, CAT_COMMU_NAME)
 
 def get_party_text_channel(guild: discord.Guild, i: int) -> Optional[discord.TextChannel]:
     cat = pp_category(guild)
     if not cat:
         return None
-    target = f"salon partie {i}"
-    for ch in cat.text_channels:
-        if target in slug(ch.name):
-            return ch
-    return None
+    return find_text_by_slug(cat, f"salon partie {i}")
+
+def set_numbers(guild: discord.Guild) -> List[int]:
+    """Numéros des sets existants (une "Préparation N" dans la catégorie PP)."""
+    return channel_index(guild).set_numbers(guild)
 
 def find_group_channels_for_set(guild: discord.Guild, i: int) -> Tuple[Optional[discord.VoiceChannel], Optional[discord.VoiceChannel], Optional[discord.VoiceChannel]]:
     """Retourne (Préparation i, Attaque, Défense) en bornant entre Préparation i et la suivante."""
-    cat = pp_category(guild)
-    if not cat: return None, None, None
-    vcs = sorted(cat.voice_channels, key=lambda c: c.position)
-    prep_idx = next((k for k, vc in enumerate(vcs) if slug(vc.name) == slug(f"préparation {i}")), None)
-    if prep_idx is None: return None, None, None
-    next_idx = next((k for k in range(prep_idx+1, len(vcs)) if slug(vcs[k].name).startswith("préparation ")), len(vcs))
-    window = vcs[prep_idx+1:next_idx]
-    atk = next((vc for vc in window if has_attack(vc.name)), None)
-    defn = next((vc for vc in window if has_defense(vc.name)), None)
-    return vcs[prep_idx], atk, defn
+    return channel_index(guild).group(guild, i)
 
 # ===================== Sécurité & rôles =====================
 UNVERIFIED_ROLE_NAME = "Non vérifié"
@@ -174,23 +329,6 @@ async def lock_category(cat: discord.CategoryChannel,
     ow[unverified] = discord.PermissionOverwrite(view_channel=is_welcome, send_messages=is_welcome)
     await cat.edit(overwrites=ow, reason="Security: category lock")
 
-async def apply_security_perms(guild: discord.Guild):
-    roles = await ensure_security_roles(guild)
-    unv, mem = roles["unverified"], roles["member"]
-    everyone = guild.default_role
-
-    def cat_by_name(name: str) -> Optional[discord.CategoryChannel]:
-        return discord.utils.get(guild.categories, name=name)
-
-    welcome = cat_by_name(CAT_WELCOME_NAME)
-    commu   = cat_by_name(CAT_COMMU_NAME)
-    fun     = cat_by_name(CAT_FUN_NAME)
-    pp      = cat_by_name(CAT_PP_NAME)
-
-    if welcome: await lock_category(welcome, everyone, unv, mem, is_welcome=True)
-    for c in [commu, fun, pp]:
-        if c: await lock_category(c, everyone, unv, mem, is_welcome=False)
-
 # ===================== CAPTCHA (robuste) =====================
 CAPTCHA_ATTEMPTS      = 3
 CAPTCHA_CODE_LEN      = 6
@@ -198,73 +336,232 @@ HUMAN_MIN_SECONDS     = 2.0     # anti "trop rapide"
 RETRY_COOLDOWN        = 8.0     # cooldown entre 2 essais
 CAPTCHA_TTL_SECONDS   = 15 * 60 # expiration (mémoire)
 ALPHABET              = "23456789ABCDEFGHJKLMNPQRSTUVWXYZ"
-_captcha_store: Dict[int, dict] = {}
-_SECRET = hashlib.sha256(str(random.random()).encode()).digest()
+CAPTCHA_WORKERS       = int(os.getenv("CAPTCHA_WORKERS", "2"))     # threads de rendu
+CAPTCHA_QUEUE_MAX     = int(os.getenv("CAPTCHA_QUEUE_MAX", "32"))  # rendus en attente max
+CAPTCHA_DEFER_AFTER   = 1.5     # au-delà, on defer l'interaction (deadline Discord = 3 s)
+CAPTCHA_POOL_SIZE     = int(os.getenv("CAPTCHA_POOL_SIZE", "16"))  # CAPTCHA pré-rendus gardés au chaud
+CAPTCHA_STORE_MAX     = 5000    # entrées max (LRU au-delà)
+CAPTCHA_SWEEP_EVERY   = 60.0    # secondes entre deux balayages des entrées expirées
+# Clé HMAC des custom_id signés (CAPTCHA, contrôles de salons) : stable d'un démarrage à l'autre,
+# sinon les boutons déjà postés deviennent invalides au redémarrage. BOT_SIGNING_SECRET si défini, sinon dérivée du token.
+_SECRET = hashlib.sha256(b"custom-id-hmac:" + (os.getenv("BOT_SIGNING_SECRET") or TOKEN or "").encode()).digest()
 
 def now() -> float: return time.time()
 def htag(s: str) -> str: return hmac.new(_SECRET, s.encode(), hashlib.sha256).hexdigest()[:16]
 def rand_text(n: int) -> str: return "".join(random.choice(ALPHABET) for _ in range(n))
 
+GLYPH_ANGLE_STEP      = 3       # pas (degrés) des sprites de caractères tournés
+NOISE_POINTS          = 450
+
+@lru_cache(maxsize=None)
 def _font():
     for f in ("DejaVuSans.ttf", "arial.ttf"):
         try: return ImageFont.truetype(f, 38)
-        except: pass
+        except Exception: metrics.swallowed()
     return ImageFont.load_default()
 
+@lru_cache(maxsize=None)
+def _glyph(ch: str, angle: int = 0) -> Image.Image:
+    """Masque (L) d'un caractère tourné de `angle` degrés, rendu une seule fois par couple."""
+    tmp = Image.new("L",(50,60),0)
+    ImageDraw.Draw(tmp).text((5,12), ch, font=_font(), fill=255)
+    return tmp.rotate(angle, expand=1, resample=Image.BICUBIC) if angle else tmp
+
+def warm_glyph_cache():
+    for ch in ALPHABET:
+        for a in range(-27, 28, GLYPH_ANGLE_STEP):
+            _glyph(ch, a)
+
+def _lut(fn) -> List[int]:
+    return [fn(v) for v in range(256)]
+
+_NOISE_GRAY_LUT = _lut(lambda v: 40 + v*81//256)              # gris 40..120
+_NOISE_MASK_LUT = _lut(lambda v: 255 if v < 4 else 0)          # ~1.5% des pixels
+
+def _noise_layer(w: int, h: int) -> Tuple[Image.Image, Image.Image]:
+    """Points de bruit (couleur, masque) générés en bloc à partir d'octets aléatoires."""
+    gray = Image.frombytes("L", (w,h), random.randbytes(w*h)).point(_NOISE_GRAY_LUT)
+    mask = Image.frombytes("L", (w,h), random.randbytes(w*h)).point(_NOISE_MASK_LUT)
+    return gray.convert("RGB"), mask
+
 def _distort(x, y, w, h):
     dx = math.sin(y/12)*3; dy = math.sin(x/15)*2
     fx = (x-w/2)*(1+(abs(y-h/2)/(h/2))*0.08)
     fy = (y-h/2)*(1+(abs(x-w/2)/(w/2))*0.06)
     return int(w/2+fx+dx), int(h/2+fy+dy)
 
+@lru_cache(maxsize=8)
+def _warp_map(w: int, h: int):
+    """Champ de déplacement précalculé (une fois par taille) : index source aplati pour chaque pixel."""
+    idx = []
+    for yy in range(h):
+        for xx in range(w):
+            sx, sy = _distort(xx,yy,w,h)
+            sx=min(max(sx,0),w-1); sy=min(max(sy,0),h-1)
+            idx.append(sy*w+sx)
+    return operator.itemgetter(*idx)
+
+def _warp(img: Image.Image) -> Image.Image:
+    """Applique _distort en un seul gather par canal (même rendu que la boucle pixel par pixel)."""
+    gather = _warp_map(*img.size)
+    bands = [Image.frombytes("L", img.size, bytes(gather(b.tobytes()))) for b in img.split()]
+    return Image.merge(img.mode, bands)
+
 def build_captcha_image(code: str) -> bytes:
     W,H = 280,110
     img = Image.new("RGB", (W,H), (28,28,30))
-    d = ImageDraw.Draw(img); font = _font()
+    d = ImageDraw.Draw(img)
 
-    for _ in range(450):
-        d.point((random.randint(0,W-1), random.randint(0,H-1)),
-                fill=(random.randint(40,120),)*3)
+    img.paste(*_noise_layer(W,H))
     for _ in range(14):
-        ch = random.choice(ALPHABET)
-        d.text((random.randint(0,W-25),random.randint(0,H-25)),
-               ch, font=font, fill=(random.randint(70,120),)*3)
+        g = _glyph(random.choice(ALPHABET))
+        img.paste((random.randint(70,120),)*3,
+                  (random.randint(-5,W-30), random.randint(-12,H-37)), g)
     for _ in range(10):
         d.line((random.randint(0,W),random.randint(0,H),
                 random.randint(0,W),random.randint(0,H)),
                fill=(random.randint(90,180),)*3, width=2)
     x = 14
     for ch in code:
-        angle = random.randint(-27,27)
-        tmp = Image.new("RGBA",(50,60),(0,0,0,0))
-        dt = ImageDraw.Draw(tmp)
-        dt.text((5,random.randint(5,20)), ch, font=font, fill=(240,240,240))
-        tmp = tmp.rotate(angle, expand=1, resample=Image.BICUBIC)
-        img.paste(tmp,(x,random.randint(10,30)),tmp)
+        angle = random.randrange(-27, 28, GLYPH_ANGLE_STEP)
+        img.paste((240,240,240), (x, random.randint(10,30)+random.randint(-7,8)), _glyph(ch, angle))
         x += random.randint(35,42)
 
-    dist = Image.new("RGB",(W,H),(28,28,30))
-    src, dst = img.load(), dist.load()
-    for yy in range(H):
-        for xx in range(W):
-            sx, sy = _distort(xx,yy,W,H)
-            sx=min(max(sx,0),W-1); sy=min(max(sy,0),H-1)
-            dst[xx,yy]=src[sx,sy]
-    dist = dist.filter(ImageFilter.SMOOTH_MORE)
+    dist = _warp(img).filter(ImageFilter.SMOOTH_MORE)
 
-    b = io.BytesIO(); dist.save(b,"PNG"); b.seek(0)
+    b = io.BytesIO(); dist.save(b,"PNG",compress_level=1); b.seek(0)
     return b.getvalue()
 
+class CaptchaRenderPool:
+    """Rendu des CAPTCHA hors event loop (threads), avec une file bornée pour la backpressure."""
+    def __init__(self, workers: int, max_pending: int):
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="captcha")
+        self.max_pending = max(1, max_pending)
+        self.pending = 0
+
+    def full(self) -> bool:
+        return self.pending >= self.max_pending
+
+    def submit(self, code: str) -> Optional[asyncio.Future]:
+        """Planifie le rendu ; None si la file est pleine."""
+        if self.full():
+            return None
+        self.pending += 1
+        fut = asyncio.get_running_loop().run_in_executor(self.executor, build_captcha_image, code)
+        fut.add_done_callback(self._done)
+        return fut
+
+    def _done(self, _fut):
+        self.pending -= 1
+
+captcha_renderer = CaptchaRenderPool(CAPTCHA_WORKERS, CAPTCHA_QUEUE_MAX)
+
+class CaptchaWarmPool:
+    """Réserve de CAPTCHA pré-rendus (code, PNG) à usage unique, rechargée en tâche de fond."""
+    def __init__(self, target: int):
+        self.target = max(0, target)
+        self.items: deque = deque()
+        self.hits = 0
+        self.misses = 0
+        self._wake = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def pop(self) -> Optional[Tuple[str, bytes]]:
+        """Retire une entrée (jamais resservie) ; None si la réserve est vide."""
+        self._wake.set()
+        if self.items:
+            self.hits += 1
+            return self.items.popleft()
+        self.misses += 1
+        return None
+
+    async def refill_loop(self, renderer: CaptchaRenderPool):
+        await asyncio.get_running_loop().run_in_executor(renderer.executor, warm_glyph_cache)
+        while True:
+            while len(self.items) < self.target:
+                # Les rendus à la demande passent avant la recharge
+                code = rand_text(CAPTCHA_CODE_LEN)
+                fut = None if renderer.pending else renderer.submit(code)
+                if fut is None:
+                    await asyncio.sleep(0.5)
+                    continue
+                try:
+                    img = await fut
+                except Exception:
+                    await asyncio.sleep(5)
+                    continue
+                self.items.append((code, img))
+            self._wake.clear()
+            await self._wake.wait()
+
+captcha_pool = CaptchaWarmPool(CAPTCHA_POOL_SIZE)
+CAPTCHA_BUSY_TEXT = "⏳ Beaucoup de vérifications en cours, réessaie dans quelques secondes."
+
 def pick_positions(n: int, k: int=3):
     return sorted(random.sample(range(1,n+1), k))
 
 def subseq(code: str, pos):
     return "".join(code[p-1] for p in pos)
 
+class CaptchaStore:
+    """uid -> état CAPTCHA, avec expiration réelle (champ "ttl"), taille bornée (LRU) et balayage par tas."""
+    def __init__(self, max_size: int):
+        self.max_size = max(1, max_size)
+        self._data: "OrderedDict[int, dict]" = OrderedDict()
+        self._heap: List[Tuple[float, int]] = []   # (expiration, uid) — entrées périmées ignorées au balayage
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __setitem__(self, uid: int, st: dict):
+        self._data[uid] = st
+        self._data.move_to_end(uid)
+        heapq.heappush(self._heap, (st["ttl"], uid))
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def get(self, uid: int) -> Optional[dict]:
+        st = self._data.get(uid)
+        if st is None:
+            return None
+        if st["ttl"] <= now():
+            del self._data[uid]
+            return None
+        self._data.move_to_end(uid)
+        return st
+
+    def pop(self, uid: int, default=None):
+        return self._data.pop(uid, default)
+
+    def sweep(self) -> int:
+        """Supprime les entrées expirées ; coût proportionnel au nombre d'expirations."""
+        t, removed = now(), 0
+        while self._heap and self._heap[0][0] <= t:
+            exp, uid = heapq.heappop(self._heap)
+            st = self._data.get(uid)
+            if st is not None and st["ttl"] == exp:
+                del self._data[uid]
+                removed += 1
+        # Le tas peut garder des doublons d'entrées remplacées/évincées : on le compacte s'il dérive
+        if len(self._heap) > 2 * len(self._data) + 64:
+            self._heap = [(st["ttl"], uid) for uid, st in self._data.items()]
+            heapq.heapify(self._heap)
+        return removed
+
+    async def sweeper(self, every: float):
+        while True:
+            await asyncio.sleep(every)
+            self.sweep()
+
+_captcha_store = CaptchaStore(CAPTCHA_STORE_MAX)
+
 class CaptchaModal(discord.ui.Modal, title="Vérification CAPTCHA"):
     answer = discord.ui.TextInput(label="Réponse (majuscules sans espace)", max_length=16)
     def __init__(self, uid: int):
         super().__init__(); self.uid = uid
+    @metrics.timed("cap:submit")
     async def on_submit(self, inter: discord.Interaction):
         st = _captcha_store.get(self.uid)
         if not st:
@@ -318,7 +615,7 @@ async def send_captcha(guild: discord.Guild, member: discord.Member):
     except discord.Forbidden:
         pass
     try:
-        cat = discord.utils.get(guild.categories, name=CAT_WELCOME_NAME)
+        cat = category_by_name(guild, CAT_WELCOME_NAME)
         if cat:
             ch = (find_text_by_slug(cat, "auto rôles")
                   or find_text_by_slug(cat, "auto-rôles")
@@ -329,7 +626,7 @@ async def send_captcha(guild: discord.Guild, member: discord.Member):
                     view=view
                 )
     except Exception:
-        pass
+        metrics.swallowed()
     return None
 
 # ===================== Ranks (Valorant) =====================
@@ -369,6 +666,7 @@ def normalize_rank(t: str) -> Optional[str]:
     div = max(1, min(divs, div))
     return f"{label} {div}"
 
+@lru_cache(maxsize=1024)
 def rank_value(display: str) -> int:
     if not display: return 0
     s = display.lower()
@@ -384,9 +682,31 @@ def rank_value(display: str) -> int:
             return ti*100 + int((d/divs)*100)
     return 0
 
+@lru_cache(maxsize=1024)
 def is_rank_role_name(name: str) -> bool:
     return any(L.lower() in name.lower() for _,L,_ in TIERS)
 
+# (guild_id, member_id) -> (valeur, nom du rôle) du peak ; tenu à jour par apply_rank_role / on_member_update
+member_ranks: Dict[Tuple[int, int], Tuple[int, Optional[str]]] = {}
+
+def _compute_peak(member: discord.Member) -> Tuple[int, Optional[str]]:
+    best, bestv = None, 0
+    for r in member.roles:
+        if is_rank_role_name(r.name):
+            v = rank_value(r.name)
+            if best is None or v > bestv: best, bestv = r.name, v
+    return bestv, best
+
+def peak_rank(member: discord.Member) -> Tuple[int, Optional[str]]:
+    key = (member.guild.id, member.id)
+    hit = member_ranks.get(key)
+    if hit is None:
+        hit = member_ranks[key] = _compute_peak(member)
+    return hit
+
+def refresh_peak_rank(member: discord.Member):
+    member_ranks[(member.guild.id, member.id)] = _compute_peak(member)
+
 async def apply_rank_role(guild: discord.Guild, member: discord.Member, display: str):
     for r in list(member.roles):
         if is_rank_role_name(r.name):
@@ -398,24 +718,24 @@ async def apply_rank_role(guild: discord.Guild, member: discord.Member, display:
     if role is None:
         role = await guild.create_role(name=display, color=col, reason="Create rank role")
     await member.add_roles(role, reason="Set peak rank")
+    member_ranks[(guild.id, member.id)] = (rank_value(display), display)
 
 # ===================== Rôles clés =====================
+KEY_ROLE_PERMS: Dict[str, discord.Permissions] = {
+    "Admin": discord.Permissions(administrator=True),
+    "Orga PP": discord.Permissions(move_members=True, mute_members=True, deafen_members=True),
+    "Staff": discord.Permissions.none(),
+    "Joueur": discord.Permissions.none(),
+    "Spectateur": discord.Permissions.none(),
+    "Équipe Attaque": discord.Permissions.none(),
+    "Équipe Défense": discord.Permissions.none(),
+}
+KEY_ROLE_KEYS = {"Admin":"admin","Orga PP":"orga","Staff":"staff","Joueur":"joueur","Spectateur":"spectateur","Équipe Attaque":"team_a","Équipe Défense":"team_b"}
+
 async def ensure_roles(guild: discord.Guild) -> Dict[str, discord.Role]:
     existing = {r.name: r for r in guild.roles}
-    perms_admin = discord.Permissions(administrator=True)
-    perms_orga  = discord.Permissions(move_members=True, mute_members=True, deafen_members=True)
-    perms_none  = discord.Permissions.none()
-    desired = {
-        "Admin": perms_admin,
-        "Orga PP": perms_orga,
-        "Staff": perms_none,
-        "Joueur": perms_none,
-        "Spectateur": perms_none,
-        "Équipe Attaque": perms_none,
-        "Équipe Défense": perms_none,
-    }
     out = {}
-    for name, perms in desired.items():
+    for name, perms in KEY_ROLE_PERMS.items():
         role = existing.get(name)
         if role is None:
             role = await guild.create_role(name=name, permissions=perms, reason="Setup roles")
@@ -425,14 +745,50 @@ async def ensure_roles(guild: discord.Guild) -> Dict[str, discord.Role]:
                     await role.edit(permissions=perms, reason="Update role perms")
             except discord.Forbidden:
                 pass
-        key = {"Admin":"admin","Orga PP":"orga","Staff":"staff","Joueur":"joueur","Spectateur":"spectateur","Équipe Attaque":"team_a","Équipe Défense":"team_b"}[name]
-        out[key] = role
+        out[KEY_ROLE_KEYS[name]] = role
     return out
 
+# ===================== Opérations Discord en masse =====================
+# Concurrence max par bucket de rate-limit (discord.py gère les 429, on évite juste de les provoquer)
+BULK_BUCKET_LIMITS: Dict[str, int] = {"roles": 5, "move": 5, "channels": 4, "messages": 3, "guild": 1}
+
+@dataclass
+class BulkResult:
+    ok: List[int] = field(default_factory=list)      # ids traités
+    failed: List[int] = field(default_factory=list)  # ids en échec (Forbidden, HTTP, …)
+
+class BulkExecutor:
+    """Exécute des opérations (ajout/retrait de rôles, déplacements vocaux) en parallèle, bornées par bucket."""
+    def __init__(self, limits: Dict[str, int]):
+        self.limits = limits
+        self._sems: Dict[str, asyncio.Semaphore] = {}
+
+    def semaphore(self, bucket: str) -> asyncio.Semaphore:
+        sem = self._sems.get(bucket)
+        if sem is None:
+            sem = self._sems[bucket] = asyncio.Semaphore(self.limits.get(bucket, 1))
+        return sem
+
+    async def run(self, bucket: str, ops: Iterable[Tuple[int, Callable[[], Awaitable]]]) -> BulkResult:
+        sem = self.semaphore(bucket)
+        async def one(key: int, op) -> Tuple[int, bool]:
+            async with sem:
+                try:
+                    await op()
+                    return key, True
+                except Exception:
+                    return key, False
+        res = BulkResult()
+        for key, ok in await asyncio.gather(*(one(k, op) for k, op in ops)):
+            (res.ok if ok else res.failed).append(key)
+        return res
+
+bulk_ops = BulkExecutor(BULK_BUCKET_LIMITS)
+
 # ===================== Vocs PP =====================
-async def create_pp_voice_structure(guild: discord.Guild, cat: discord.CategoryChannel):
+async def create_pp_voice_structure(guild: discord.Guild, cat: discord.CategoryChannel, sets: Optional[Iterable[int]] = None):
     """Crée/ajuste Préparation i + Attaque/Défense (avec emojis) et applique les limites."""
-    for i in range(1, PREP_PAIRS+1):
+    for i in (sets if sets is not None else range(1, PREP_SETS_MIN+1)):
         prep = discord.utils.find(lambda vc: slug(vc.name)==slug(f"préparation {i}"), cat.voice_channels)
         if not prep:
             await guild.create_voice_channel(f"Préparation {i}", category=cat, user_limit=PREP_VOICE_LIMIT)
@@ -446,179 +802,472 @@ async def create_pp_voice_structure(guild: discord.Guild, cat: discord.CategoryC
         else:
             if not has_attack(atk.name):
                 try: await atk.edit(name="⚔ · Attaque")
-                except: pass
+                except Exception: metrics.swallowed()
             try: await atk.edit(user_limit=SIDE_VOICE_LIMIT)
-            except: pass
+            except Exception: metrics.swallowed()
         if not defn:
             await guild.create_voice_channel("🛡 · Défense", category=cat, user_limit=SIDE_VOICE_LIMIT)
         else:
             if not has_defense(defn.name):
                 try: await defn.edit(name="🛡 · Défense")
-                except: pass
+                except Exception: metrics.swallowed()
             try: await defn.edit(user_limit=SIDE_VOICE_LIMIT)
-            except: pass
+            except Exception: metrics.swallowed()
+
+# ===================== Équilibrage des équipes =====================
+BALANCE_EXACT_MAX   = 14     # au-delà : heuristique (C(14,7)/2 = 1716 partitions max en exact)
+BALANCE_TIME_BUDGET = 0.05   # secondes max pour l'heuristique
+
+def _spread(vals: List[int]) -> int:
+    return max(vals) - min(vals) if vals else 0
+
+def team_cost(values: Dict[int, int], a: Iterable[int], b: Iterable[int]) -> Tuple[int, int]:
+    """(écart de total, écart de dispersion) — comparé lexicographiquement, plus petit = mieux."""
+    va = [values[u] for u in a]; vb = [values[u] for u in b]
+    return abs(sum(va) - sum(vb)), abs(_spread(va) - _spread(vb))
+
+def _units(values: Dict[int, int], groups: Iterable[Iterable[int]]) -> List[Tuple[int, ...]]:
+    """Regroupe les joueurs en unités indivisibles (premades), les autres sont seuls."""
+    seen: Set[int] = set(); units = []
+    for g in groups:
+        u = tuple(x for x in g if x in values and x not in seen)
+        if u:
+            seen.update(u); units.append(u)
+    units += [(x,) for x in values if x not in seen]
+    return units
+
+def balance_exact(values: Dict[int, int], groups: Iterable[Iterable[int]] = ()) -> Tuple[List[int], List[int]]:
+    """Parcourt toutes les partitions en deux équipes de taille n//2 et n-n//2 (premades non séparés)."""
+    ids = list(values)
+    units = _units(values, groups)
+    half = len(ids) // 2
+    best, best_cost = None, None
+    # L'unité 0 est fixée dans A : chaque partition n'est vue qu'une fois
+    for k in range(len(units)):
+        for rest in itertools.combinations(range(1, len(units)), k):
+            a = [x for i in (0,) + rest for x in units[i]]
+            if len(a) not in (half, len(ids) - half):
+                continue
+            sa = set(a); b = [x for x in ids if x not in sa]
+            cost = team_cost(values, a, b)
+            if best_cost is None or cost < best_cost:
+                best, best_cost = (a, b), cost
+                if cost == (0, 0): return best
+    if best is None:
+        # Premades impossibles à caser (plus gros qu'une équipe, tailles incompatibles) :
+        # on libère le plus gros et on recommence, les autres restent groupés
+        premades = [u for u in units if len(u) > 1]
+        if not premades:
+            return ids[:half], ids[half:]
+        premades.remove(max(premades, key=len))
+        return balance_exact(values, premades)
+    return best
+
+def balance_heuristic(values: Dict[int, int], groups: Iterable[Iterable[int]] = ()) -> Tuple[List[int], List[int]]:
+    """Répartition gloutonne puis échanges d'unités de même taille, dans un budget de temps borné."""
+    units = sorted(_units(values, groups), key=lambda u: (-len(u), -sum(values[x] for x in u)))
+    n = len(values)
+    caps = (n // 2, n - n // 2)
+    # reach[i] : bitset des effectifs atteignables avec units[i:] — garantit qu'un placement laisse une fin possible
+    reach = [1] * (len(units) + 1)
+    for i in range(len(units) - 1, -1, -1):
+        reach[i] = reach[i + 1] | (reach[i + 1] << len(units[i]))
+    if not reach[0] >> caps[0] & 1:
+        # Aucune répartition ne respecte tous les premades : on libère le plus gros (comme balance_exact)
+        premades = [u for u in units if len(u) > 1]
+        premades.remove(max(premades, key=len))
+        return balance_heuristic(values, premades)
+    A: List[Tuple[int, ...]] = []; B: List[Tuple[int, ...]] = []
+    sides, sums, sizes = (A, B), [0, 0], [0, 0]
+    for i, u in enumerate(units):
+        order = (0, 1) if sums[0] <= sums[1] else (1, 0)
+        k = next(k for k in order if sizes[k] + len(u) <= caps[k]
+                 and reach[i + 1] >> (caps[0] - sizes[0] - (len(u) if k == 0 else 0)) & 1)
+        sides[k].append(u); sums[k] += sum(values[x] for x in u); sizes[k] += len(u)
+    flat = lambda side: [x for u in side for x in u]
+    cost = team_cost(values, flat(A), flat(B))
+    deadline = time.perf_counter() + BALANCE_TIME_BUDGET
+    improved = True
+    while improved and cost != (0, 0) and time.perf_counter() < deadline:
+        improved = False
+        for i, ua in enumerate(A):
+            for j, ub in enumerate(B):
+                if len(ua) != len(ub): continue
+                A[i], B[j] = ub, ua
+                c = team_cost(values, flat(A), flat(B))
+                if c < cost:
+                    cost, improved = c, True
+                    ua = A[i]
+                else:
+                    A[i], B[j] = ua, ub
+            if time.perf_counter() >= deadline: break
+    return flat(A), flat(B)
+
+def balance_teams(values: Dict[int, int], groups: Iterable[Iterable[int]] = ()) -> Tuple[List[int], List[int]]:
+    """values: id -> valeur de rang. Exact jusqu'à BALANCE_EXACT_MAX joueurs, heuristique au-delà."""
+    if len(values) <= BALANCE_EXACT_MAX:
+        return balance_exact(values, groups)
+    return balance_heuristic(values, groups)
 
 # ===================== File 5v5 & Panneau =====================
 class SetQueues:
-    def __init__(self): self.queues: Dict[int, List[int]] = {i: [] for i in range(1, PREP_PAIRS+1)}
+    """Files par set sur OrderedDict (appartenance, retrait et tête en O(1)).
+
+    Un joueur n'est que dans une file à la fois : `where` est l'index inverse uid -> set.
+    Les files sont créées à la demande (nombre de sets dynamique).
+    """
+    def __init__(self):
+        self.queues: Dict[int, "OrderedDict[int, None]"] = {}
+        self.where: Dict[int, int] = {}
+    def _q(self, i:int) -> "OrderedDict[int, None]":
+        q=self.queues.get(i)
+        if q is None: q=self.queues[i]=OrderedDict()
+        return q
     def join(self, i:int, uid:int)->bool:
-        q=self.queues[i]
-        if uid in q: return False
-        q.append(uid); return True
+        if uid in self.where: return False
+        self._q(i)[uid]=None; self.where[uid]=i; persist_queue(i); return True
     def leave(self,i:int,uid:int)->bool:
-        q=self.queues[i]
-        if uid not in q: return False
-        q.remove(uid); return True
-    def ready(self,i:int)->bool: return len(self.queues[i])>=10
+        if self.where.get(uid)!=i: return False
+        del self.queues[i][uid]; del self.where[uid]; persist_queue(i); return True
+    def size(self,i:int)->int: return len(self.queues.get(i, ()))
+    def ready(self,i:int)->bool: return self.size(i)>=10
     def pop10(self,i:int)->List[int]:
-        q=self.queues[i]; p=q[:10]; self.queues[i]=q[10:]; return p
-    def list(self,i:int)->List[int]: return list(self.queues[i])
+        q=self._q(i); p=[]
+        while q and len(p)<10:
+            uid,_=q.popitem(last=False); del self.where[uid]; p.append(uid)
+        persist_queue(i); return p
+    def reset(self,i:int):
+        q=self._q(i)
+        for uid in q: self.where.pop(uid, None)
+        q.clear(); persist_queue(i)
+    def drop(self,i:int):
+        """Supprime la file d'un set démonté."""
+        for uid in self.queues.pop(i, ()): self.where.pop(uid, None)
+        state_store.delete(f"queue:{i}")
+    def load(self,i:int,uids:Iterable[int]):
+        """Remplace la file i (restauration) en respectant une seule file par joueur."""
+        self.reset(i)
+        for uid in uids: self.join(i, uid)
+    def list(self,i:int):
+        """Vue en lecture (ordre d'arrivée), sans copie ; ne crée pas de file pour un set inconnu."""
+        q = self.queues.get(i)
+        return q.keys() if q is not None else {}.keys()
 
 set_queues = SetQueues()
 
+def persist_queue(i: int):
+    state_store.put(f"queue:{i}", set_queues.queues[i].keys())
+
+PANEL_FLUSH_INTERVAL = 1.5   # secondes : au plus une édition du panneau par set et par intervalle
+
+_mention_cache: Dict[Tuple[int, int], str] = {}   # (guild_id, uid) -> mention rendue
+
+def member_mention(guild: discord.Guild, uid: int) -> str:
+    key = (guild.id, uid)
+    txt = _mention_cache.get(key)
+    if txt is None:
+        m = guild.get_member(uid)
+        if not m:
+            return f"`{uid}`"
+        txt = _mention_cache[key] = m.mention
+    return txt
+
 def panel_embed(guild:discord.Guild,i:int)->discord.Embed:
     ids=set_queues.list(i)
-    mentions=[]
-    for uid in ids:
-        m=guild.get_member(uid)
-        mentions.append(m.mention if m else f"`{uid}`")
+    mentions=[member_mention(guild, uid) for uid in ids]
     em=discord.Embed(title=f"Préparation {i} — File 5v5", description="Rejoins la file et lance une partie équilibrée.", color=0x5865F2)
     em.add_field(name=f"Joueurs ({len(ids)}/10)", value=", ".join(mentions) if mentions else "—", inline=False)
     em.set_footer(text="Boutons: Rejoindre • Quitter • Lancer • Finir")
     return em
 
-async def ensure_panel_once(chat:discord.TextChannel, embed:discord.Embed, view:discord.ui.View):
-    try:
-        pins = await chat.pins()
-        for m in pins:
-            if m.author==chat.guild.me and m.embeds and m.embeds[0].title==embed.title:
-                return
-    except: pass
-    async for m in chat.history(limit=30):
-        if m.author==chat.guild.me and m.embeds and m.embeds[0].title==embed.title:
+class PanelRenderer:
+    """Marque le panneau d'un set comme modifié et regroupe les éditions (une par intervalle au plus)."""
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.targets: Dict[int, Tuple[discord.Guild, discord.Message]] = {}
+        self.tasks: Dict[int, asyncio.Task] = {}
+        self.edits = 0
+
+    def mark_dirty(self, i: int, guild: discord.Guild, message: Optional[discord.Message]):
+        if message is None:
             return
-    msg = await chat.send(embed=embed, view=view)
+        self.targets[i] = (guild, message)
+        t = self.tasks.get(i)
+        if t is None or t.done():
+            self.tasks[i] = asyncio.create_task(self._flush_later(i))
+
+    async def _flush_later(self, i: int):
+        # Les clics arrivés pendant l'attente (ou pendant l'édition) sont absorbés par le même passage
+        while i in self.targets:
+            await asyncio.sleep(self.interval)
+            guild, message = self.targets.pop(i)
+            try:
+                await message.edit(embed=panel_embed(guild, i))
+                self.edits += 1
+            except Exception:
+                metrics.swallowed()
+
+panel_renderer = PanelRenderer(PANEL_FLUSH_INTERVAL)
+
+class PanelRegistry:
+    """(guild, type, set) -> (salon, message) des panneaux du bot, persisté : un fetch_message au lieu d'un scan."""
+    def __init__(self):
+        self.entries: Dict[str, Tuple[int, int]] = {}
+
+    @staticmethod
+    def key(guild_id: int, kind: str, set_idx: int) -> str:
+        return f"panelmsg:{guild_id}:{kind}:{set_idx}"
+
+    def remember(self, msg: discord.Message, kind: str, set_idx: int):
+        k = self.key(msg.guild.id, kind, set_idx)
+        self.entries[k] = (msg.channel.id, msg.id)
+        state_store.put(k, list(self.entries[k]))
+
+    def has(self, chat: Optional[discord.abc.GuildChannel], kind: str, set_idx: int = 0) -> bool:
+        """Sans await : un message de ce type est enregistré dans ce salon (plan_setup)."""
+        ent = self.entries.get(self.key(chat.guild.id, kind, set_idx)) if chat is not None else None
+        return ent is not None and ent[0] == chat.id
+
+    def forget(self, guild_id: int, kind: str, set_idx: int):
+        k = self.key(guild_id, kind, set_idx)
+        if self.entries.pop(k, None) is not None:
+            state_store.delete(k)
+
+    async def fetch(self, chat: discord.TextChannel, kind: str, set_idx: int) -> Optional[discord.Message]:
+        ent = self.entries.get(self.key(chat.guild.id, kind, set_idx))
+        if not ent or ent[0] != chat.id:
+            return None
+        try:
+            return await chat.fetch_message(ent[1])
+        except discord.NotFound:
+            self.forget(chat.guild.id, kind, set_idx)
+        except discord.HTTPException:
+            pass
+        return None
+
+panel_registry = PanelRegistry()
+
+async def ensure_message_once(chat: discord.TextChannel, kind: str, set_idx: int,
+                              match: Callable[[discord.Message], bool],
+                              send: Callable[[], Awaitable[discord.Message]],
+                              refresh: Optional[Callable[[discord.Message], Awaitable[Any]]] = None,
+                              history: int = 30) -> discord.Message:
+    """Registre d'abord ; pins + historique seulement en secours. Existant : mis à jour sur place (refresh)."""
+    msg = await panel_registry.fetch(chat, kind, set_idx)
+    if msg is None:
+        me = chat.guild.me
+        try:
+            msg = next((m for m in await chat.pins() if m.author == me and match(m)), None)
+        except Exception: metrics.swallowed()
+        if msg is None:
+            async for m in chat.history(limit=history):
+                if m.author == me and match(m):
+                    msg = m; break
+        if msg is not None:
+            panel_registry.remember(msg, kind, set_idx)
+    if msg is not None:
+        if refresh:
+            try: await refresh(msg)
+            except Exception: metrics.swallowed()
+        return msg
+    msg = await send()
+    panel_registry.remember(msg, kind, set_idx)
     try: await msg.pin()
-    except: pass
+    except Exception: metrics.swallowed()
+    return msg
+
+async def ensure_panel_once(chat:discord.TextChannel, set_idx:int):
+    title = f"Préparation {set_idx} — File 5v5"
+    await ensure_message_once(
+        chat, "panel", set_idx,
+        match=lambda m: bool(m.embeds) and m.embeds[0].title == title,
+        send=lambda: chat.send(embed=panel_embed(chat.guild, set_idx), view=PanelView(set_idx)),
+        refresh=lambda m: m.edit(embed=panel_embed(chat.guild, set_idx)),
+    )
 
-async def purge_channel_messages(chat: discord.TextChannel, keep_pins: bool = True, limit: int = 500):
-    pins = []
+PARTY_PURGE_MODE     = os.getenv("PARTY_PURGE_MODE", "auto")   # targeted | recreate | auto
+PURGE_RECREATE_ABOVE = 400   # auto : au-delà de ce nombre de messages suivis, on recrée le salon
+BULK_DELETE_MAX_AGE  = datetime.timedelta(days=14, minutes=-5)   # limite Discord de la suppression groupée (marge incluse)
+
+class PartyMessageTracker:
+    """IDs des messages postés dans chaque salon-partie depuis le dernier nettoyage.
+
+    Avant le premier nettoyage d'un salon (depuis le démarrage), les messages plus anciens que
+    `started` ne sont pas connus : un scan d'historique borné les couvre une fois.
+    """
+    def __init__(self):
+        self.ids: Dict[int, Set[int]] = {}
+        self.clean: Set[int] = set()   # salons nettoyés depuis le démarrage : rien d'inconnu avant la fenêtre
+        self.started = discord.utils.time_snowflake(discord.utils.utcnow())
+
+    def track(self, channel_id: int, message_id: int):
+        self.ids.setdefault(channel_id, set()).add(message_id)
+
+    def untrack(self, channel_id: int, message_ids: Iterable[int]):
+        s = self.ids.get(channel_id)
+        if s: s.difference_update(message_ids)
+
+    def take(self, channel_id: int) -> Set[int]:
+        return self.ids.pop(channel_id, set())
+
+party_tracker = PartyMessageTracker()
+
+def party_channel_ids(guild: discord.Guild) -> Set[int]:
+    """Mis en cache dans ChannelIndex (invalidé avec lui)."""
+    return channel_index(guild).party_ids(guild)
+
+async def recreate_channel(chat: discord.TextChannel) -> discord.TextChannel:
+    """Clone le salon (nom, sujet, permissions, position) puis supprime l'original."""
+    new = await chat.clone(reason="Nettoyage salon-partie")
+    try: await new.edit(position=chat.position)
+    except Exception: metrics.swallowed()
+    await chat.delete(reason="Nettoyage salon-partie")
+    party_tracker.clean.add(new.id)
+    return new
+
+async def purge_channel_messages(chat: discord.TextChannel, keep_pins: bool = True, limit: int = 500) -> discord.TextChannel:
+    """Supprime les messages suivis par lots de 100 ; scan d'historique seulement pour ce qui précède la fenêtre.
+    Retourne le salon à utiliser ensuite (nouveau salon si recréé)."""
+    tracked = party_tracker.take(chat.id)
+    panels = {mid for (cid, mid) in panel_registry.entries.values() if cid == chat.id}
+    pinned: Set[int] = set()
     if keep_pins:
+        try: pinned = {m.id for m in await chat.pins()}
+        except Exception: metrics.swallowed()
+    keep = panels | pinned
+    fresh = chat.id in party_tracker.clean
+
+    # Recréer coûte ~3 appels quel que soit le volume ; en auto, seulement si rien d'autre que nos panneaux n'est épinglé
+    if PARTY_PURGE_MODE == "recreate" or (
+            PARTY_PURGE_MODE == "auto" and len(tracked) > PURGE_RECREATE_ABOVE and pinned <= panels):
         try:
-            pins = await chat.pins()
-        except:
-            pins = []
-    pinned_ids = {m.id for m in pins}
-    try:
-        await chat.purge(limit=limit, check=(lambda m: m.id not in pinned_ids))
-    except discord.Forbidden:
-        pass
-    except Exception:
-        pass
+            return await recreate_channel(chat)
+        except Exception:
+            metrics.swallowed()
+
+    # Discord refuse tout le lot si un message a plus de 14 jours : ceux-là partent un par un
+    cutoff = discord.utils.utcnow() - BULK_DELETE_MAX_AGE
+    ids = [m for m in tracked if m not in keep]
+    young = [discord.Object(id=m) for m in ids if discord.utils.snowflake_time(m) > cutoff]
+    old = [m for m in ids if discord.utils.snowflake_time(m) <= cutoff]
+    for k in range(0, len(young), 100):
+        try:
+            await chat.delete_messages(young[k:k+100], reason="Match terminé")
+        except Exception:
+            metrics.swallowed()
+    if old:
+        await bulk_ops.run("messages", [(m, lambda m=m: chat.get_partial_message(m).delete()) for m in old])
+    if not fresh:
+        try:
+            await chat.purge(limit=limit, before=discord.Object(id=party_tracker.started),
+                             check=(lambda m: m.id not in keep))
+        except Exception:
+            metrics.swallowed()
+        party_tracker.clean.add(chat.id)
+    return chat
+
+def layout_view(view: discord.ui.View) -> discord.ui.View:
+    """Vue servant uniquement de gabarit de boutons : arrêtée pour que discord.py ne la garde pas
+    en mémoire par message ; les clics passent par les routeurs on_interaction (custom_id)."""
+    view.stop()
+    return view
 
 class PanelView(discord.ui.View):
     def __init__(self,set_idx:int):
         super().__init__(timeout=None); self.set_idx=set_idx
-        b_join  = discord.ui.Button(label="✅ Rejoindre", style=discord.ButtonStyle.success,   custom_id=f"panel:join:{set_idx}")
-        b_leave = discord.ui.Button(label="🚪 Quitter",  style=discord.ButtonStyle.secondary, custom_id=f"panel:leave:{set_idx}")
-        b_start = discord.ui.Button(label="🚀 Lancer la partie", style=discord.ButtonStyle.primary, custom_id=f"panel:start:{set_idx}")
-        b_end   = discord.ui.Button(label="🧹 Finir la partie",  style=discord.ButtonStyle.danger,  custom_id=f"panel:end:{set_idx}")
-
-        async def cb_join(inter:discord.Interaction):
-            if not set_queues.join(self.set_idx, inter.user.id):
-                return await inter.response.send_message("Tu es déjà dans la file.", ephemeral=True)
-            await inter.response.send_message(f"Tu as rejoint la file (Préparation {self.set_idx}).", ephemeral=True)
-            try: await inter.message.edit(embed=panel_embed(inter.guild,self.set_idx), view=self)
-            except: pass
-
-        async def cb_leave(inter:discord.Interaction):
-            if not set_queues.leave(self.set_idx, inter.user.id):
-                return await inter.response.send_message("Tu n'es pas dans la file.", ephemeral=True)
-            await inter.response.send_message("Tu as quitté la file.", ephemeral=True)
-            try: await inter.message.edit(embed=panel_embed(inter.guild,self.set_idx), view=self)
-            except: pass
-
-        async def cb_start(inter:discord.Interaction):
-            roles = {r.name.lower() for r in inter.user.roles}
-            if 'orga pp' not in roles and not inter.user.guild_permissions.administrator:
-                return await inter.response.send_message("Orga PP requis.", ephemeral=True)
-            await inter.response.defer(ephemeral=True)
-            if not set_queues.ready(self.set_idx):
-                need = 10 - len(set_queues.list(self.set_idx))
-                return await inter.followup.send(f"Il manque **{need}** joueurs.", ephemeral=True)
-            guild = inter.guild
-            ids = set_queues.pop10(self.set_idx)
-            members = [guild.get_member(u) for u in ids if guild.get_member(u)]
-
-            def val(m:discord.Member)->int:
-                best=0
-                for r in m.roles:
-                    if is_rank_role_name(r.name): best=max(best, rank_value(r.name))
-                return best
-            scored=sorted([(m,val(m)) for m in members], key=lambda x:x[1], reverse=True)
-            A,B=[],[]; sa=sb=0
-            for m,v in scored:
-                if sa<=sb: A.append(m); sa+=v
-                else: B.append(m); sb+=v
-
-            key_roles = await ensure_roles(guild)
-            roleA, roleB = key_roles["team_a"], key_roles["team_b"]
-            _, atk, defn = find_group_channels_for_set(guild, self.set_idx)
-
-            for m in A:
-                try: await m.add_roles(roleA)
-                except: pass
-                if atk and m.voice and m.voice.channel:
-                    try: await m.move_to(atk)
-                    except: pass
-            for m in B:
-                try: await m.add_roles(roleB)
-                except: pass
-                if defn and m.voice and m.voice.channel:
-                    try: await m.move_to(defn)
-                    except: pass
-
-            em=discord.Embed(title=f"Match lancé — Préparation {self.set_idx}", description="Équilibrage par peak ELO.", color=0x2ecc71)
-            em.add_field(name="Équipe Attaque", value=", ".join(m.mention for m in A) or "—", inline=False)
-            em.add_field(name="Équipe Défense", value=", ".join(m.mention for m in B) or "—", inline=False)
-            await inter.followup.send(embed=em)
-
-            try: await inter.message.edit(embed=panel_embed(guild,self.set_idx), view=self)
-            except: pass
-
-        async def cb_end(inter:discord.Interaction):
-            roles = {r.name.lower() for r in inter.user.roles}
-            if 'orga pp' not in roles and not inter.user.guild_permissions.administrator:
-                return await inter.response.send_message("Orga PP requis.", ephemeral=True)
-            await inter.response.defer(ephemeral=True)
-            guild = inter.guild
-            key_roles = await ensure_roles(guild)
-            removed = 0
-            for m in guild.members:
-                if key_roles["team_a"] in m.roles or key_roles["team_b"] in m.roles:
-                    try:
-                        await m.remove_roles(key_roles["team_a"], key_roles["team_b"], reason="Match terminé")
-                        removed += 1
-                    except: pass
-            # Reset file + votes
-            set_queues.queues[self.set_idx] = []
-            if self.set_idx in map_votes:
-                mv = map_votes[self.set_idx]
-                mv.voters.clear(); mv.yes=0; mv.no=0; mv.locked=False
-
-            # CLEAR salon-partie-i & replanter panneaux
-            chat = get_party_text_channel(guild, self.set_idx)
-            if chat:
-                await purge_channel_messages(chat, keep_pins=True, limit=500)
-                await ensure_panel_once(chat, panel_embed(guild, self.set_idx), PanelView(self.set_idx))
-                await ensure_mapvote_panel_once(chat, self.set_idx)
-
-            await inter.followup.send(f"Rôles retirés de **{removed}** membres. File réinitialisée. Salon-partie nettoyé.", ephemeral=True)
-            try: await inter.message.edit(embed=panel_embed(guild,self.set_idx), view=self)
-            except: pass
-
-        b_join.callback=cb_join; b_leave.callback=cb_leave; b_start.callback=cb_start; b_end.callback=cb_end
-        self.add_item(b_join); self.add_item(b_leave); self.add_item(b_start); self.add_item(b_end)
+        self.add_item(discord.ui.Button(label="✅ Rejoindre", style=discord.ButtonStyle.success,   custom_id=f"panel:join:{set_idx}"))
+        self.add_item(discord.ui.Button(label="🚪 Quitter",  style=discord.ButtonStyle.secondary, custom_id=f"panel:leave:{set_idx}"))
+        self.add_item(discord.ui.Button(label="🚀 Lancer la partie", style=discord.ButtonStyle.primary, custom_id=f"panel:start:{set_idx}"))
+        self.add_item(discord.ui.Button(label="🧹 Finir la partie",  style=discord.ButtonStyle.danger,  custom_id=f"panel:end:{set_idx}"))
+        layout_view(self)
+
+async def panel_join(inter:discord.Interaction, i:int):
+    if not set_queues.join(i, inter.user.id):
+        other = set_queues.where.get(inter.user.id)
+        if other != i:
+            return await inter.response.send_message(f"Tu es déjà dans la file de **Préparation {other}**. Quitte-la d'abord.", ephemeral=True)
+        return await inter.response.send_message("Tu es déjà dans la file.", ephemeral=True)
+    await inter.response.send_message(f"Tu as rejoint la file (Préparation {i}).", ephemeral=True)
+    panel_renderer.mark_dirty(i, inter.guild, inter.message)
+    if set_queues.ready(i):
+        asyncio.create_task(maybe_provision_set(inter.guild))
+
+async def panel_leave(inter:discord.Interaction, i:int):
+    if not set_queues.leave(i, inter.user.id):
+        return await inter.response.send_message("Tu n'es pas dans la file.", ephemeral=True)
+    await inter.response.send_message("Tu as quitté la file.", ephemeral=True)
+    panel_renderer.mark_dirty(i, inter.guild, inter.message)
+
+async def panel_start(inter:discord.Interaction, i:int):
+    roles = {r.name.lower() for r in inter.user.roles}
+    if 'orga pp' not in roles and not inter.user.guild_permissions.administrator:
+        return await inter.response.send_message("Orga PP requis.", ephemeral=True)
+    await inter.response.defer(ephemeral=True)
+    if not set_queues.ready(i):
+        need = 10 - set_queues.size(i)
+        return await inter.followup.send(f"Il manque **{need}** joueurs.", ephemeral=True)
+    guild = inter.guild
+    ids = set_queues.pop10(i)
+    members = [m for m in map(guild.get_member, ids) if m]
+
+    by_id = {m.id: m for m in members}
+    values = {m.id: peak_rank(m)[0] for m in members}
+    ids_a, ids_b = balance_teams(values)
+    A = [by_id[u] for u in ids_a]; B = [by_id[u] for u in ids_b]
+    sa = sum(values[u] for u in ids_a); sb = sum(values[u] for u in ids_b)
+
+    key_roles = await ensure_roles(guild)
+    roleA, roleB = key_roles["team_a"], key_roles["team_b"]
+    _, atk, defn = find_group_channels_for_set(guild, i)
+
+    role_ops = [(m.id, (lambda m=m, r=r: m.add_roles(r))) for team, r in ((A, roleA), (B, roleB)) for m in team]
+    move_ops = [(m.id, (lambda m=m, vc=vc: m.move_to(vc)))
+                for team, vc in ((A, atk), (B, defn)) if vc
+                for m in team if m.voice and m.voice.channel]
+    res_roles, res_moves = await asyncio.gather(bulk_ops.run("roles", role_ops), bulk_ops.run("move", move_ops))
+
+    em=discord.Embed(title=f"Match lancé — Préparation {i}", description=f"Équilibrage par peak ELO (total {sa} vs {sb}).", color=0x2ecc71)
+    em.add_field(name="Équipe Attaque", value=", ".join(m.mention for m in A) or "—", inline=False)
+    em.add_field(name="Équipe Défense", value=", ".join(m.mention for m in B) or "—", inline=False)
+    failed = len(res_roles.failed) + len(res_moves.failed)
+    if failed:
+        em.set_footer(text=f"⚠️ {failed} action(s) Discord en échec (rôles/déplacements).")
+    await inter.followup.send(embed=em)
+
+    panel_renderer.mark_dirty(i, guild, inter.message)
+
+async def panel_end(inter:discord.Interaction, i:int):
+    roles = {r.name.lower() for r in inter.user.roles}
+    if 'orga pp' not in roles and not inter.user.guild_permissions.administrator:
+        return await inter.response.send_message("Orga PP requis.", ephemeral=True)
+    await inter.response.defer(ephemeral=True)
+    guild = inter.guild
+    key_roles = await ensure_roles(guild)
+    teams = {m.id: m for r in (key_roles["team_a"], key_roles["team_b"]) for m in r.members}
+    res = await bulk_ops.run("roles", [
+        (uid, (lambda m=m: m.remove_roles(key_roles["team_a"], key_roles["team_b"], reason="Match terminé")))
+        for uid, m in teams.items()
+    ])
+    removed = len(res.ok)
+    # Reset file + votes
+    set_queues.reset(i)
+    if i in map_votes:
+        mv = map_votes[i]
+        mv.voters.clear(); mv.yes=0; mv.no=0; mv.locked=False
+        persist_mapvote(i)
+
+    # CLEAR salon-partie-i & replanter panneaux
+    chat = get_party_text_channel(guild, i)
+    if chat:
+        chat = await purge_channel_messages(chat, keep_pins=True, limit=500)
+        await ensure_panel_once(chat, i)
+        await ensure_mapvote_panel_once(chat, i)
+
+    fail_txt = f" ⚠️ Échec pour **{len(res.failed)}** membres." if res.failed else ""
+    await inter.followup.send(f"Rôles retirés de **{removed}** membres.{fail_txt} File réinitialisée. Salon-partie nettoyé.", ephemeral=True)
+    panel_renderer.mark_dirty(i, guild, inter.message)
+
+PANEL_ACTIONS = {"join": panel_join, "leave": panel_leave, "start": panel_start, "end": panel_end}
 
 # ===================== Embeds de base =====================
 SERVER_RULES_TEXT = """**RÈGLEMENT DU SERVEUR — ARÈNE DE KAER MORHEN**
@@ -629,23 +1278,23 @@ PP_RULES_TEXT = """**RÈGLEMENT PARTIES PERSO — VALORANT**
 Fair-play, pas de triche, vocal Attaque/Défense, party-code privé, sanctions graduées.
 """
 
-async def post_server_rules(ch:discord.TextChannel):
+async def post_pinned_once(ch:discord.TextChannel, text:str, kind:str):
+    """Épinglé une seule fois ; passe par panel_registry pour que plan_setup le voie dans l'instantané."""
     try:
-        msg = await ch.send(SERVER_RULES_TEXT)
-        try: await msg.pin()
-        except: pass
-    except: pass
+        await ensure_message_once(ch, kind, 0, match=lambda m: m.content.strip()==text.strip(),
+                                  send=lambda: ch.send(text), history=25)
+    except Exception: metrics.swallowed()
+
+async def post_server_rules(ch:discord.TextChannel):
+    await post_pinned_once(ch, SERVER_RULES_TEXT, "rules")
 
 async def post_rules_pp(ch:discord.TextChannel):
-    try:
-        msg = await ch.send(PP_RULES_TEXT)
-        try: await msg.pin()
-        except: pass
-    except: pass
+    await post_pinned_once(ch, PP_RULES_TEXT, "rules_pp")
 
 # ===================== Peak ELO dans auto-rôles =====================
 class RankModal(discord.ui.Modal, title="Déclare ton peak ELO (VALORANT)"):
     rank_input = discord.ui.TextInput(label="Ex: Silver 1, Asc 1, Immortal 2, Radiant", placeholder="asc 1", required=True, max_length=32)
+    @metrics.timed("rank:submit")
     async def on_submit(self, interaction: discord.Interaction):
         disp = normalize_rank(str(self.rank_input.value))
         if not disp:
@@ -656,24 +1305,20 @@ class RankModal(discord.ui.Modal, title="Déclare ton peak ELO (VALORANT)"):
 class RankButtonView(discord.ui.View):
     def __init__(self): super().__init__(timeout=None)
     @discord.ui.button(label="🎯 Déclarer mon peak ELO", style=discord.ButtonStyle.primary, custom_id="rank:open")
+    @metrics.timed("rank:open")
     async def open(self, interaction:discord.Interaction, button:discord.ui.Button):
         await interaction.response.send_modal(RankModal())
 
 async def ensure_rank_prompt_in_autoroles(guild:discord.Guild, cat_welcome:discord.CategoryChannel):
     ch = find_text_by_slug(cat_welcome, "auto rôles") or find_text_by_slug(cat_welcome, "auto-roles")
     if not ch: return
-    try:
-        for m in await ch.pins():
-            if m.author==guild.me and m.components:
-                return
-    except: pass
-    async for m in ch.history(limit=25):
-        if m.author==guild.me and m.components:
-            return
     em = discord.Embed(title="🎯 Peak ELO — Valorant", description="Clique pour déclarer ton **peak ELO** et recevoir ton rôle.", color=0x5865F2)
-    msg = await ch.send(embed=em, view=RankButtonView())
-    try: await msg.pin()
-    except: pass
+    await ensure_message_once(
+        ch, "rank", 0,
+        match=lambda m: bool(m.components),
+        send=lambda: ch.send(embed=em, view=RankButtonView()),
+        history=25,
+    )
 
 # ===================== Roulette map + votes =====================
 VALORANT_MAPS = [
@@ -681,27 +1326,165 @@ VALORANT_MAPS = [
     "Icebox","Breeze","Pearl","Fracture","Corrode","Abyss"
 ]
 
-MAP_IMAGE: Dict[str, str] = {
-    "Haven":    "https://c-valorant-api.op.gg/Assets/Maps/2BEE0DC9-4FFE-519B-1CBD-7FBE763A6047_splash.png?image=q_auto:good,f_webp&v=1760610922",
-    "Corrode":  "https://c-valorant-api.op.gg/Assets/Maps/1C18AB1F-420D-0D8B-71D0-77AD3C439115_splash.png?image=q_auto:good,f_webp&v=1760610922",
-    "Icebox":   "https://c-valorant-api.op.gg/Assets/Maps/E2AD5C54-4114-A870-9641-8EA21279579A_splash.png?image=q_auto:good,f_webp&v=1760610922",
-    "Pearl":    "https://c-valorant-api.op.gg/Assets/Maps/FD267378-4D1D-484F-FF52-77821ED10DC2_splash.png?image=q_auto:good,f_webp&v=1760610922",
-    "Sunset":   "https://c-valorant-api.op.gg/Assets/Maps/92584FBE-486A-B1B2-9FAA-39B0F486B498_splash.png?image=q_auto:good,f_webp&v=1760610922",
-    "Lotus":    "https://c-valorant-api.op.gg/Assets/Maps/2FE4ED3A-450A-948B-6D6B-E89A78E680A9_splash.png?image=q_auto:good,f_webp&v=1760610922",
-    "Abyss":    "https://c-valorant-api.op.gg/Assets/Maps/224B0A95-48B9-F703-1BD8-67ACA101A61F_splash.png?image=q_auto:good,f_webp&v=1760610922",
-    "Breeze":   "https://c-valorant-api.op.gg/Assets/Maps/2FB9A4FD-47B8-4E7D-A969-74B4046EBD53_splash.png?image=q_auto:good,f_webp&v=1760610922",
-    "Ascent":   "https://c-valorant-api.op.gg/Assets/Maps/7EAECC1B-4337-BBF6-6AB9-04B8F06B3319_splash.png?image=q_auto:good,f_webp&v=1760610922",
-    "Split":    "https://c-valorant-api.op.gg/Assets/Maps/D960549E-485C-E861-8D71-AA9D1AED12A2_splash.png?image=q_auto:good,f_webp&v=1760610922",
-    "Fracture": "https://c-valorant-api.op.gg/Assets/Maps/B529448B-4D60-346E-E89E-00A4C527A405_splash.png?image=q_auto:good,f_webp&v=1760610922",
-    "Bind":     "https://c-valorant-api.op.gg/Assets/Maps/2C9D57EC-4431-9C5E-2939-8F9EF6DD5CBA_splash.png?image=q_auto:good,f_webp&v=1760610922",
-}
 MAP_ALIASES: Dict[str, str] = {"abysse": "Abyss", "corode": "Corrode", "ice box": "Icebox"}
+MAP_DIR            = os.path.join(os.path.dirname(os.path.abspath(__file__)), "MAP")
+MAP_IMAGE_SIZE     = (640, 360)   # format max des vignettes (16:9) : réduites au-delà, jamais agrandies
+MAP_ASSET_CHANNEL  = "🗃️・assets-maps"
+MAP_URL_MIN_TTL_S  = 6 * 3600     # URL CDN signée : renouvelée en tâche de fond si elle expire avant
+MAP_URL_MARGIN_S   = 300          # en deçà, l'URL n'est plus utilisée (fichier local joint)
+MAP_UPLOAD_RETRY_S = 300          # délai avant une nouvelle tentative après un upload raté
+
+def map_key(name: str) -> str:
+    return MAP_ALIASES.get(name.strip().lower(), name.strip())
+
+def map_filename(name: str) -> str:
+    return f"{map_key(name).lower()}.webp"
+
+@lru_cache(maxsize=64)
+def _cdn_expiry(url: str) -> float:
+    """Les URLs d'attachement Discord sont signées (?ex=<hex>) ; sans ex= on les considère permanentes."""
+    ex = urllib.parse.parse_qs(urllib.parse.urlsplit(url).query).get("ex")
+    try:
+        return int(ex[0], 16) if ex else math.inf
+    except ValueError:
+        return 0.0
+
+class MapAssets:
+    """Images des maps : MAP/*.webp chargées une fois (réduites si plus grandes que MAP_IMAGE_SIZE), uploadées
+    une fois dans un salon d'assets ; l'URL de l'attachement (mapimg:<map>) et l'ID du message qui la porte
+    (mapmsg:<map>) sont persistés. Les URLs signées expirent (~24 h) : files(name, guild) relance en fond un
+    fetch de ce message (upload s'il a disparu) dès qu'une URL approche de l'expiration, l'ancienne restant utilisée d'ici là. Sans URL valide, l'embed pointe sur attachment://
+    et le fichier local est joint au message."""
+
+    def __init__(self, directory: str = MAP_DIR):
+        self.directory = directory
+        self.images: Dict[str, bytes] = {}   # map -> webp (source, ou réduit)
+        self.urls: Dict[str, str] = {}       # map -> URL CDN
+        self.messages: Dict[str, int] = {}   # map -> ID du message d'assets qui porte l'image
+        self._uploading: Optional[asyncio.Task] = None
+        self._retry_at = 0.0
+
+    def preload(self):
+        """Bloquant (PIL) : à appeler hors de la boucle."""
+        for name in VALORANT_MAPS:
+            path = os.path.join(self.directory, f"{name}.webp")
+            try:
+                with Image.open(path) as im:
+                    w, h = MAP_IMAGE_SIZE
+                    if im.format == "WEBP" and (im.width <= w or im.height <= h):
+                        # Agrandir n'ajoute aucun détail et triple le poids ré-uploadé à chaque refresh
+                        with open(path, "rb") as f:
+                            self.images[name] = f.read()
+                        continue
+                    if im.width > w and im.height > h:
+                        im = ImageOps.fit(im.convert("RGB"), MAP_IMAGE_SIZE, Image.LANCZOS)
+                    buf = io.BytesIO()
+                    im.convert("RGB").save(buf, format="WEBP", quality=85, method=4)
+            except OSError:
+                continue
+            self.images[name] = buf.getvalue()
+
+    def _left(self, name: str) -> float:
+        u = self.urls.get(name)
+        return _cdn_expiry(u) - time.time() if u else -math.inf
+
+    def url(self, name: str) -> Optional[str]:
+        key = map_key(name)
+        return self.urls[key] if self._left(key) > MAP_URL_MARGIN_S else None
+
+    def image_url(self, name: str) -> Optional[str]:
+        """URL à mettre dans l'embed : CDN si dispo, sinon fichier joint, sinon rien."""
+        key = map_key(name)
+        return self.url(key) or (f"attachment://{map_filename(key)}" if key in self.images else None)
+
+    def files(self, name: str, guild: Optional[discord.Guild] = None) -> List[discord.File]:
+        """Fichiers à joindre avec l'embed (vide si l'URL CDN suffit — efface aussi un ancien fichier joint).
+        Avec `guild`, relance l'upload en fond si des URLs manquent ou vont expirer."""
+        key = map_key(name)
+        if guild is not None:
+            self.ensure_uploaded(guild)
+        if self.url(key) or key not in self.images:
+            return []
+        return [discord.File(io.BytesIO(self.images[key]), filename=map_filename(key))]
+
+    def missing(self) -> List[str]:
+        """Maps sans URL ou dont l'URL expire dans moins de MAP_URL_MIN_TTL_S."""
+        return [m for m in self.images if self._left(m) <= MAP_URL_MIN_TTL_S]
+
+    async def asset_channel(self, guild: discord.Guild) -> Optional[discord.TextChannel]:
+        cid = os.getenv("MAP_ASSET_CHANNEL_ID")
+        if cid and cid.isdigit():
+            ch = guild.get_channel(int(cid))
+            return ch if isinstance(ch, discord.TextChannel) else None
+        cat = pp_category(guild)
+        if not cat:
+            return None
+        ch = find_text_by_slug(cat, slug(MAP_ASSET_CHANNEL))
+        if ch is None:
+            ch = await guild.create_text_channel(
+                MAP_ASSET_CHANNEL, category=cat, reason="Images des maps (assets bot)",
+                overwrites={guild.default_role: discord.PermissionOverwrite(view_channel=False),
+                            guild.me: discord.PermissionOverwrite(view_channel=True, send_messages=True, attach_files=True)},
+            )
+        return ch
+
+    def _adopt(self, msg: discord.Message) -> int:
+        """Retient les URLs des attachements de `msg` (et le message qui les porte) ; renvoie leur nombre."""
+        by_file = {map_filename(m): m for m in self.images}
+        got = 0
+        for att in msg.attachments:
+            name = by_file.get(att.filename)
+            if name:
+                self.urls[name], self.messages[name] = att.url, msg.id
+                state_store.put(f"mapimg:{name}", att.url)
+                state_store.put(f"mapmsg:{name}", msg.id)
+                got += 1
+        return got
+
+    async def upload(self, guild: discord.Guild) -> int:
+        """Renouvelle les URLs sans validité suffisante ; renvoie le nombre d'URLs obtenues.
+
+        Un fetch du message d'assets existant rend des URLs fraîchement signées : on ne ré-uploade
+        (10 fichiers par message) que les images dont le message a disparu, puis on supprime les
+        anciens messages qui ne portent plus aucune image."""
+        if not self.missing():
+            return 0
+        ch = await self.asset_channel(guild)
+        if ch is None:
+            return 0
+        got = 0
+        for mid in {self.messages[m] for m in self.missing() if m in self.messages}:
+            try:
+                got += self._adopt(await ch.fetch_message(mid))
+            except discord.HTTPException:
+                continue   # message supprimé / illisible : ré-upload ci-dessous
+        todo = self.missing()
+        stale = {self.messages[m] for m in todo if m in self.messages}
+        for k in range(0, len(todo), 10):
+            files = [discord.File(io.BytesIO(self.images[m]), filename=map_filename(m)) for m in todo[k:k+10]]
+            got += self._adopt(await ch.send(files=files))
+        for mid in stale - set(self.messages.values()):
+            try:
+                await ch.get_partial_message(mid).delete()
+            except discord.HTTPException:
+                metrics.swallowed("map_upload")
+        return got
+
+    def ensure_uploaded(self, guild: discord.Guild):
+        """Lance l'upload en tâche de fond (une seule à la fois, pas plus d'un essai raté par MAP_UPLOAD_RETRY_S)."""
+        if (self._uploading is None or self._uploading.done()) and time.time() >= self._retry_at and self.missing():
+            self._uploading = asyncio.create_task(self._upload_quietly(guild))
+
+    async def _upload_quietly(self, guild: discord.Guild):
+        try:
+            ok = await self.upload(guild)
+        except Exception:
+            ok = 0
+            metrics.swallowed("map_upload")
+        if not ok:
+            self._retry_at = time.time() + MAP_UPLOAD_RETRY_S
 
-def map_image_url(name: str) -> str:
-    key = MAP_ALIASES.get(name.strip().lower(), None)
-    if key is None:
-        key = name.strip()
-    return MAP_IMAGE.get(key) or f"https://dummyimage.com/1280x640/111827/ffffff&text={name.replace(' ', '%20')}"
+map_assets = MapAssets()
 
 @dataclass
 class MapVoteState:
@@ -712,6 +1495,14 @@ class MapVoteState:
     locked: bool = False  # true = acceptée
 
 map_votes: Dict[int, MapVoteState] = {}
+
+def persist_mapvote(set_idx: int):
+    state_store.put(f"mapvote:{set_idx}", asdict(map_votes[set_idx]))
+
+def load_mapvote(data: dict) -> MapVoteState:
+    st = MapVoteState(**data)
+    st.voters = {int(k): v for k, v in st.voters.items()}   # JSON : clés en str
+    return st
 VOTE_THRESHOLD_ACCEPT = 5
 VOTE_THRESHOLD_REJECT = 5
 
@@ -728,7 +1519,9 @@ def build_map_embed(set_idx: int, state: MapVoteState) -> discord.Embed:
     )
     color = 0x2ecc71 if state.locked else 0x5865F2
     em = discord.Embed(title=title, description=desc, color=color)
-    em.set_image(url=map_image_url(state.current))
+    img = map_assets.image_url(state.current)
+    if img:
+        em.set_image(url=img)
     em.set_footer(text="✅ Map acceptée" if state.locked else "Votez avec les boutons ci-dessous")
     return em
 
@@ -736,78 +1529,139 @@ class MapVoteView(discord.ui.View):
     def __init__(self, set_idx: int):
         super().__init__(timeout=None)
         self.set_idx = set_idx
-        b_yes    = discord.ui.Button(label="✅ Oui", style=discord.ButtonStyle.success,   custom_id=f"mapvote:yes:{set_idx}")
-        b_no     = discord.ui.Button(label="❌ Non", style=discord.ButtonStyle.danger,    custom_id=f"mapvote:no:{set_idx}")
-        b_reroll = discord.ui.Button(label="🎲 Relancer (Orga)", style=discord.ButtonStyle.secondary, custom_id=f"mapvote:reroll:{set_idx}")
-
-        async def cb_yes(inter: discord.Interaction):
-            state = map_votes.get(self.set_idx)
-            if not state:
-                state = map_votes[self.set_idx] = MapVoteState(current=roll_random_map())
-            if state.locked:
-                return await inter.response.send_message("La map est déjà acceptée.", ephemeral=True)
-            uid = inter.user.id
-            if uid in state.voters:
-                return await inter.response.send_message("Tu as déjà voté.", ephemeral=True)
-            state.voters[uid] = "yes"; state.yes += 1
-            if state.yes >= VOTE_THRESHOLD_ACCEPT:
-                state.locked = True
-            await inter.response.edit_message(embed=build_map_embed(self.set_idx, state), view=self)
-            await inter.followup.send("Vote enregistré ✅", ephemeral=True)
-
-        async def cb_no(inter: discord.Interaction):
-            state = map_votes.get(self.set_idx)
-            if not state:
-                state = map_votes[self.set_idx] = MapVoteState(current=roll_random_map())
-            if state.locked:
-                return await inter.response.send_message("La map est déjà acceptée.", ephemeral=True)
-            uid = inter.user.id
-            if uid in state.voters:
-                return await inter.response.send_message("Tu as déjà voté.", ephemeral=True)
-            state.voters[uid] = "no"; state.no += 1
-            rerolled = False
-            if state.no >= VOTE_THRESHOLD_REJECT:
-                old = state.current
-                state.current = roll_random_map(exclude=old)
-                state.voters.clear(); state.yes = 0; state.no = 0; state.locked = False
-                rerolled = True
-            await inter.response.edit_message(embed=build_map_embed(self.set_idx, state), view=self)
-            await inter.followup.send(
-                "❌ Refusé (5 non). 🎲 Nouvelle map proposée !" if rerolled else "Vote enregistré ❌",
-                ephemeral=True
-            )
+        self.add_item(discord.ui.Button(label="✅ Oui", style=discord.ButtonStyle.success,   custom_id=f"mapvote:yes:{set_idx}"))
+        self.add_item(discord.ui.Button(label="❌ Non", style=discord.ButtonStyle.danger,    custom_id=f"mapvote:no:{set_idx}"))
+        self.add_item(discord.ui.Button(label="🎲 Relancer (Orga)", style=discord.ButtonStyle.secondary, custom_id=f"mapvote:reroll:{set_idx}"))
+        layout_view(self)
+
+async def mapvote_yes(inter: discord.Interaction, set_idx: int):
+    state = map_votes.get(set_idx)
+    if not state:
+        state = map_votes[set_idx] = MapVoteState(current=roll_random_map())
+    if state.locked:
+        return await inter.response.send_message("La map est déjà acceptée.", ephemeral=True)
+    uid = inter.user.id
+    if uid in state.voters:
+        return await inter.response.send_message("Tu as déjà voté.", ephemeral=True)
+    state.voters[uid] = "yes"; state.yes += 1
+    if state.yes >= VOTE_THRESHOLD_ACCEPT:
+        state.locked = True
+    persist_mapvote(set_idx)
+    await inter.response.edit_message(embed=build_map_embed(set_idx, state), attachments=map_assets.files(state.current, inter.guild))
+    await inter.followup.send("Vote enregistré ✅", ephemeral=True)
+
+async def mapvote_no(inter: discord.Interaction, set_idx: int):
+    state = map_votes.get(set_idx)
+    if not state:
+        state = map_votes[set_idx] = MapVoteState(current=roll_random_map())
+    if state.locked:
+        return await inter.response.send_message("La map est déjà acceptée.", ephemeral=True)
+    uid = inter.user.id
+    if uid in state.voters:
+        return await inter.response.send_message("Tu as déjà voté.", ephemeral=True)
+    state.voters[uid] = "no"; state.no += 1
+    rerolled = False
+    if state.no >= VOTE_THRESHOLD_REJECT:
+        old = state.current
+        state.current = roll_random_map(exclude=old)
+        state.voters.clear(); state.yes = 0; state.no = 0; state.locked = False
+        rerolled = True
+    persist_mapvote(set_idx)
+    await inter.response.edit_message(embed=build_map_embed(set_idx, state), attachments=map_assets.files(state.current, inter.guild))
+    await inter.followup.send(
+        "❌ Refusé (5 non). 🎲 Nouvelle map proposée !" if rerolled else "Vote enregistré ❌",
+        ephemeral=True
+    )
 
-        async def cb_reroll(inter: discord.Interaction):
-            if not (inter.user.guild_permissions.administrator or any(r.name.lower()=="orga pp" for r in inter.user.roles)):
-                return await inter.response.send_message("Réservé aux **Orga PP** / Admin.", ephemeral=True)
-            state = map_votes.get(self.set_idx)
-            if not state:
-                state = map_votes[self.set_idx] = MapVoteState(current=roll_random_map())
-            old = state.current
-            state.current = roll_random_map(exclude=old)
-            state.voters.clear(); state.yes = 0; state.no = 0; state.locked = False
-            await inter.response.edit_message(embed=build_map_embed(self.set_idx, state), view=self)
-            await inter.followup.send("🎲 Nouvelle map proposée.", ephemeral=True)
-
-        b_yes.callback = cb_yes
-        b_no.callback  = cb_no
-        b_reroll.callback = cb_reroll
-        self.add_item(b_yes); self.add_item(b_no); self.add_item(b_reroll)
+async def mapvote_reroll(inter: discord.Interaction, set_idx: int):
+    if not (inter.user.guild_permissions.administrator or any(r.name.lower()=="orga pp" for r in inter.user.roles)):
+        return await inter.response.send_message("Réservé aux **Orga PP** / Admin.", ephemeral=True)
+    state = map_votes.get(set_idx)
+    if not state:
+        state = map_votes[set_idx] = MapVoteState(current=roll_random_map())
+    old = state.current
+    state.current = roll_random_map(exclude=old)
+    state.voters.clear(); state.yes = 0; state.no = 0; state.locked = False
+    persist_mapvote(set_idx)
+    await inter.response.edit_message(embed=build_map_embed(set_idx, state), attachments=map_assets.files(state.current, inter.guild))
+    await inter.followup.send("🎲 Nouvelle map proposée.", ephemeral=True)
+
+MAPVOTE_ACTIONS = {"yes": mapvote_yes, "no": mapvote_no, "reroll": mapvote_reroll}
 
 async def ensure_mapvote_panel_once(chat: discord.TextChannel, set_idx: int):
     title = f"🗺️ Roulette map — Partie {set_idx}"
+    def state() -> MapVoteState:
+        if set_idx not in map_votes:
+            map_votes[set_idx] = MapVoteState(current=roll_random_map())
+            persist_mapvote(set_idx)
+        return map_votes[set_idx]
+    await ensure_message_once(
+        chat, "mapvote", set_idx,
+        match=lambda m: bool(m.embeds) and m.embeds[0].title == title,
+        send=lambda: chat.send(embed=build_map_embed(set_idx, state()), files=map_assets.files(state().current, chat.guild), view=MapVoteView(set_idx)),
+        refresh=lambda m: m.edit(embed=build_map_embed(set_idx, state()), attachments=map_assets.files(state().current, chat.guild)),
+    )
+
+# ===================== Sets dynamiques =====================
+_set_idle_since: Dict[Tuple[int, int], float] = {}   # (guild_id, set) -> début d'inactivité
+_provisioning: Set[int] = set()                      # guildes avec un provisionnement en cours
+
+async def provision_set(guild: discord.Guild, i: int) -> bool:
+    """Crée Préparation i / Attaque / Défense + salon-partie-i et y pose les panneaux."""
+    cat = pp_category(guild)
+    if not cat:
+        return False
+    await create_pp_voice_structure(guild, cat, [i])
+    chat = get_party_text_channel(guild, i)
+    if chat is None:
+        chat = await guild.create_text_channel(f"• salon-partie-{i}", category=cat, reason="PP party chat")
+    await ensure_panel_once(chat, i)
+    await ensure_mapvote_panel_once(chat, i)
+    return True
+
+async def maybe_provision_set(guild: discord.Guild):
+    """Ouvre un set supplémentaire quand toutes les files existantes sont pleines."""
+    nums = set_numbers(guild)
+    if guild.id in _provisioning or len(nums) >= PREP_SETS_MAX:
+        return
+    if any(not set_queues.ready(i) for i in nums):
+        return
+    _provisioning.add(guild.id)
     try:
-        for m in await chat.pins():
-            if m.author == chat.guild.me and m.embeds and m.embeds[0].title == title:
-                return
-    except: pass
-    async for m in chat.history(limit=30):
-        if m.author == chat.guild.me and m.embeds and m.embeds[0].title == title:
-            return
-    map_votes[set_idx] = MapVoteState(current=roll_random_map())
-    msg = await chat.send(embed=build_map_embed(set_idx, map_votes[set_idx]), view=MapVoteView(set_idx))
-    try: await msg.pin()
-    except: pass
+        nxt = next(k for k in itertools.count(1) if k not in nums)
+        await provision_set(guild, nxt)
+    except Exception:
+        metrics.swallowed()
+    finally:
+        _provisioning.discard(guild.id)
+
+async def teardown_set(guild: discord.Guild, i: int):
+    prep, atk, defn = find_group_channels_for_set(guild, i)
+    for ch in (get_party_text_channel(guild, i), prep, atk, defn):
+        if ch:
+            try: await ch.delete(reason="Set PP inactif")
+            except Exception: metrics.swallowed()
+    set_queues.drop(i)
+    if map_votes.pop(i, None) is not None:
+        state_store.delete(f"mapvote:{i}")
+    _set_idle_since.pop((guild.id, i), None)
+    for kind in ("panel", "mapvote"):
+        panel_registry.forget(guild.id, kind, i)
+
+async def set_reaper(client: commands.Bot, every: float = 60.0):
+    """Démonte les sets au-delà de PREP_SETS_MIN restés vides (file + vocaux) pendant SET_IDLE_TEARDOWN_S."""
+    while True:
+        await asyncio.sleep(every)
+        for g in client.guilds:
+            for i in set_numbers(g):
+                if i <= PREP_SETS_MIN:
+                    continue
+                key = (g.id, i)
+                if set_queues.size(i) or any(vc and vc.members for vc in find_group_channels_for_set(g, i)):
+                    _set_idle_since.pop(key, None)
+                    continue
+                if now() - _set_idle_since.setdefault(key, now()) >= SET_IDLE_TEARDOWN_S:
+                    await teardown_set(g, i)
 
 # ===================== Temp voice (création dans TAVERNE) =====================
 @dataclass
@@ -821,165 +1675,573 @@ class TempRoom:
     blacklist: Set[int] = field(default_factory=set)
 
 temp_rooms: Dict[int, TempRoom] = {}        # voice_id -> TempRoom
-delete_tasks: Dict[int, asyncio.Task] = {}  # voice_id -> task
+
+def persist_room(room: TempRoom):
+    d = asdict(room)
+    d["whitelist"] = sorted(room.whitelist); d["blacklist"] = sorted(room.blacklist)
+    state_store.put(f"room:{room.voice_id}", d)
+
+def load_room(data: dict) -> TempRoom:
+    room = TempRoom(**data)
+    room.whitelist = set(room.whitelist); room.blacklist = set(room.blacklist)
+    return room
 
 def staff_or_owner(member: discord.Member, room: TempRoom) -> bool:
     if member.guild_permissions.administrator: return True
     low = {r.name.lower() for r in member.roles}
     return member.id == room.owner_id or "orga pp" in low
 
+def compile_room_overwrites(vc: discord.VoiceChannel, room: TempRoom, touched: Iterable[int] = ()) -> Dict[Any, discord.PermissionOverwrite]:
+    """Traduit privé / whitelist / blacklist en overwrites `connect` : Discord refuse la connexion lui-même.
+    `touched` : IDs retirés d'une liste dont l'overwrite doit être nettoyé."""
+    guild = vc.guild
+    ow = dict(vc.overwrites)
+    members = {t.id: t for t in ow if not isinstance(t, discord.Role)}
+    def set_connect(target, value: Optional[bool]):
+        po = discord.PermissionOverwrite.from_pair(*ow[target].pair()) if target in ow else discord.PermissionOverwrite()
+        po.connect = value
+        if po.is_empty(): ow.pop(target, None)
+        else: ow[target] = po
+    set_connect(guild.default_role, not room.private)
+    allowed = room.whitelist | {room.owner_id} if room.private else set()
+    for uid in (set(touched) | room.whitelist | room.blacklist | {room.owner_id}) - {0}:
+        target = members.get(uid) or guild.get_member(uid) or discord.Object(id=uid, type=discord.Member)
+        set_connect(target, False if uid in room.blacklist else (True if uid in allowed else None))
+    return ow
+
+async def apply_room_access(vc: discord.VoiceChannel, room: TempRoom, touched: Iterable[int] = (), reason: str = "VC access"):
+    """Un seul vc.edit par changement (aucun si rien ne change) ; l'expulsion des présents désormais refusés
+    part en tâche de fond (bulk_ops), l'appelant n'attend pas les move_to."""
+    ow = compile_room_overwrites(vc, room, touched)
+    if ow != vc.overwrites:
+        await vc.edit(overwrites=ow, reason=reason)
+    evict = [m for m in vc.members if room_denies(room, m)]
+    if evict:
+        asyncio.create_task(bulk_ops.run("move", [(m.id, lambda m=m: m.move_to(None, reason=reason)) for m in evict]))
+
+async def commit_room_access(inter: discord.Interaction, vc: discord.VoiceChannel, room: TempRoom,
+                             rollback: Callable[[], None], done: str, **kw):
+    """Changement d'accès déjà appliqué à `room` : defer d'abord (deadline de 3 s), vc.edit ensuite,
+    persistance seulement si Discord l'a accepté — sinon `rollback` et message d'échec."""
+    await inter.response.defer(ephemeral=True, thinking=True)
+    try:
+        await apply_room_access(vc, room, **kw)
+    except discord.HTTPException:
+        rollback()
+        return await inter.followup.send("Discord a refusé la modification du salon, réessaie dans un instant.", ephemeral=True)
+    persist_room(room)
+    await inter.followup.send(done, ephemeral=True)
+
+ROOM_BUTTONS = [
+    ("private", "🔒 Rendre privé",  discord.ButtonStyle.danger),
+    ("public",  "🔓 Rendre public", discord.ButtonStyle.success),
+    ("limit",   "👥 Limite",        discord.ButtonStyle.secondary),
+    ("wl_add",  "✅ Whitelist+",    discord.ButtonStyle.success),
+    ("wl_del",  "🗑️ Whitelist-",    discord.ButtonStyle.secondary),
+    ("bl_add",  "⛔ Blacklist+",    discord.ButtonStyle.danger),
+    ("bl_del",  "🧹 Blacklist-",    discord.ButtonStyle.secondary),
+    ("lists",   "📜 Voir listes",   discord.ButtonStyle.secondary),
+]
+ROOM_OPEN_ACTIONS = {"lists"}   # le reste : créateur / Orga PP / admin
+
+def room_custom_id(action: str, voice_id: int) -> str:
+    return f"vc:{action}:{voice_id}:{htag(f'vc:{action}:{voice_id}')}"
+
 class VoiceControlView(discord.ui.View):
+    """Gabarit des contrôles d'un salon temporaire : custom_id signé portant l'ID du salon, clics traités par rooms_router."""
     def __init__(self, room: TempRoom):
         super().__init__(timeout=None)
-        self.room = room
-
-    async def _resolve(self, interaction: discord.Interaction) -> Tuple[Optional[discord.VoiceChannel], Optional[TempRoom]]:
-        vc = interaction.guild.get_channel(self.room.voice_id)
-        if not vc:
-            await interaction.response.send_message("Salon introuvable.", ephemeral=True)
-            return None, None
-        return vc, temp_rooms.get(vc.id)
-
-    @discord.ui.button(label="🔒 Rendre privé", style=discord.ButtonStyle.danger, custom_id="vc:private")
-    async def make_private(self, interaction:discord.Interaction, _:discord.ui.Button):
-        vc, room = await self._resolve(interaction)
-        if not vc or not room: return
-        if not staff_or_owner(interaction.user, room):
-            return await interaction.response.send_message("Réservé au créateur/Orga PP.", ephemeral=True)
-        overwrites = vc.overwrites
-        overwrites[interaction.guild.default_role] = discord.PermissionOverwrite(connect=False)
-        await vc.edit(overwrites=overwrites, reason="VC private")
-        room.private = True
-        await interaction.response.send_message("Salon **privé**.", ephemeral=True)
-
-    @discord.ui.button(label="🔓 Rendre public", style=discord.ButtonStyle.success, custom_id="vc:public")
-    async def make_public(self, interaction:discord.Interaction, _:discord.ui.Button):
-        vc, room = await self._resolve(interaction)
-        if not vc or not room: return
-        if not staff_or_owner(interaction.user, room):
-            return await interaction.response.send_message("Réservé au créateur/Orga PP.", ephemeral=True)
-        overwrites = vc.overwrites
-        overwrites[interaction.guild.default_role] = discord.PermissionOverwrite(connect=True)
-        await vc.edit(overwrites=overwrites, reason="VC public")
-        room.private = False
-        await interaction.response.send_message("Salon **public**.", ephemeral=True)
-
-    @discord.ui.button(label="👥 Limite", style=discord.ButtonStyle.secondary, custom_id="vc:limit")
-    async def set_limit(self, interaction:discord.Interaction, _:discord.ui.Button):
-        vc, room = await self._resolve(interaction)
-        if not vc or not room: return
-        if not staff_or_owner(interaction.user, room):
-            return await interaction.response.send_message("Réservé au créateur/Orga PP.", ephemeral=True)
-        class LimitModal(discord.ui.Modal, title="Fixer une limite (0 = illimité)"):
-            value = discord.ui.TextInput(label="Nombre", placeholder="0..99", required=True, max_length=2)
-            async def on_submit(self, inter: discord.Interaction):
-                try:
-                    n = int(str(self.value))
-                    n = max(0, min(99, n))
-                except:
-                    return await inter.response.send_message("Nombre invalide.", ephemeral=True)
-                try: await vc.edit(user_limit=n)
-                except: pass
-                room.limit = n
-                await inter.response.send_message(f"Limite fixée à **{n}**.", ephemeral=True)
-        await interaction.response.send_modal(LimitModal())
-
-    @discord.ui.button(label="✅ Whitelist+", style=discord.ButtonStyle.success, custom_id="vc:wl_add")
-    async def wl_add(self, interaction:discord.Interaction, _:discord.ui.Button):
-        vc, room = await self._resolve(interaction)
-        if not vc or not room: return
-        if not staff_or_owner(interaction.user, room):
-            return await interaction.response.send_message("Réservé au créateur/Orga PP.", ephemeral=True)
-        class AddModal(discord.ui.Modal, title="Ajouter à la whitelist"):
-            user = discord.ui.TextInput(label="ID ou @mention", required=True)
-            async def on_submit(self, inter:discord.Interaction):
-                m = re.findall(r"\d{15,20}", str(self.user))
-                if not m:
-                    return await inter.response.send_message("Utilisateur invalide.", ephemeral=True)
-                room.whitelist.add(int(m[0]))
-                await inter.response.send_message("Ajouté à la whitelist.", ephemeral=True)
-        await interaction.response.send_modal(AddModal())
-
-    @discord.ui.button(label="🗑️ Whitelist-", style=discord.ButtonStyle.secondary, custom_id="vc:wl_del")
-    async def wl_del(self, interaction:discord.Interaction, _:discord.ui.Button):
-        vc, room = await self._resolve(interaction)
-        if not vc or not room: return
-        if not staff_or_owner(interaction.user, room):
-            return await interaction.response.send_message("Réservé au créateur/Orga PP.", ephemeral=True)
-        class DelModal(discord.ui.Modal, title="Retirer de la whitelist"):
-            user = discord.ui.TextInput(label="ID ou @mention", required=True)
-            async def on_submit(self, inter:discord.Interaction):
-                m = re.findall(r"\d{15,20}", str(self.user))
-                if not m:
-                    return await inter.response.send_message("Utilisateur invalide.", ephemeral=True)
-                room.whitelist.discard(int(m[0]))
-                await inter.response.send_message("Retiré de la whitelist.", ephemeral=True)
-        await interaction.response.send_modal(DelModal())
-
-    @discord.ui.button(label="⛔ Blacklist+", style=discord.ButtonStyle.danger, custom_id="vc:bl_add")
-    async def bl_add(self, interaction:discord.Interaction, _:discord.ui.Button):
-        vc, room = await self._resolve(interaction)
-        if not vc or not room: return
-        if not staff_or_owner(interaction.user, room):
-            return await interaction.response.send_message("Réservé au créateur/Orga PP.", ephemeral=True)
-        class AddModal(discord.ui.Modal, title="Ajouter à la blacklist"):
-            user = discord.ui.TextInput(label="ID ou @mention", required=True)
-            async def on_submit(self, inter:discord.Interaction):
-                m = re.findall(r"\d{15,20}", str(self.user))
-                if not m:
-                    return await inter.response.send_message("Utilisateur invalide.", ephemeral=True)
-                room.blacklist.add(int(m[0]))
-                await inter.response.send_message("Ajouté à la blacklist.", ephemeral=True)
-        await interaction.response.send_modal(AddModal())
-
-    @discord.ui.button(label="🧹 Blacklist-", style=discord.ButtonStyle.secondary, custom_id="vc:bl_del")
-    async def bl_del(self, interaction:discord.Interaction, _:discord.ui.Button):
-        vc, room = await self._resolve(interaction)
-        if not vc or not room: return
-        if not staff_or_owner(interaction.user, room):
-            return await interaction.response.send_message("Réservé au créateur/Orga PP.", ephemeral=True)
-        class DelModal(discord.ui.Modal, title="Retirer de la blacklist"):
-            user = discord.ui.TextInput(label="ID ou @mention", required=True)
-            async def on_submit(self, inter:discord.Interaction):
-                m = re.findall(r"\d{15,20}", str(self.user))
-                if not m:
-                    return await inter.response.send_message("Utilisateur invalide.", ephemeral=True)
-                room.blacklist.discard(int(m[0]))
-                await inter.response.send_message("Retiré de la blacklist.", ephemeral=True)
-        await interaction.response.send_modal(DelModal())
-
-    @discord.ui.button(label="📜 Voir listes", style=discord.ButtonStyle.secondary, custom_id="vc:lists")
-    async def lists(self, interaction:discord.Interaction, _:discord.ui.Button):
-        vc, room = await self._resolve(interaction)
-        if not vc or not room: return
-        wl = ", ".join(f"<@{u}>" for u in room.whitelist) or "—"
-        bl = ", ".join(f"<@{u}>" for u in room.blacklist) or "—"
-        await interaction.response.send_message(f"**Whitelist**: {wl}\n**Blacklist**: {bl}", ephemeral=True)
-
-async def start_delete_timer(guild: discord.Guild, voice_id: int):
-    await asyncio.sleep(TEMP_DELETE_GRACE_S)
-    room = temp_rooms.get(voice_id)
-    if not room: return
-    vc = guild.get_channel(voice_id)
-    if vc and len(vc.members) == 0:
+        for action, label, style in ROOM_BUTTONS:
+            self.add_item(discord.ui.Button(label=label, style=style, custom_id=room_custom_id(action, room.voice_id)))
+        layout_view(self)
+
+def _room_of(inter: discord.Interaction, voice_id: int) -> Tuple[Optional[discord.VoiceChannel], Optional[TempRoom]]:
+    return inter.guild.get_channel(voice_id), temp_rooms.get(voice_id)
+
+class RoomLimitModal(discord.ui.Modal, title="Fixer une limite (0 = illimité)"):
+    value = discord.ui.TextInput(label="Nombre", placeholder="0..99", required=True, max_length=2)
+    def __init__(self, voice_id: int):
+        super().__init__(); self.voice_id = voice_id
+    @metrics.timed("vc:limit:submit")
+    async def on_submit(self, inter: discord.Interaction):
         try:
-            txt = guild.get_channel(room.text_id)
-            if txt: await txt.delete()
-        except: pass
-        try: await vc.delete()
-        except: pass
-        temp_rooms.pop(voice_id, None)
-        delete_tasks.pop(voice_id, None)
+            n = int(str(self.value))
+            n = max(0, min(99, n))
+        except:
+            return await inter.response.send_message("Nombre invalide.", ephemeral=True)
+        vc, room = _room_of(inter, self.voice_id)
+        if not vc or not room:
+            return await inter.response.send_message("Salon introuvable.", ephemeral=True)
+        try: await vc.edit(user_limit=n)
+        except Exception: metrics.swallowed()
+        room.limit = n
+        persist_room(room)
+        await inter.response.send_message(f"Limite fixée à **{n}**.", ephemeral=True)
+
+class RoomListModal(discord.ui.Modal):
+    user = discord.ui.TextInput(label="ID ou @mention", required=True)
+    def __init__(self, voice_id: int, list_name: str, add: bool, title: str, done: str):
+        super().__init__(title=title)
+        self.voice_id, self.list_name, self.add, self.done = voice_id, list_name, add, done
+    @metrics.timed("vc:list:submit")
+    async def on_submit(self, inter: discord.Interaction):
+        m = re.findall(r"\d{15,20}", str(self.user))
+        if not m:
+            return await inter.response.send_message("Utilisateur invalide.", ephemeral=True)
+        vc, room = _room_of(inter, self.voice_id)
+        if not vc or not room:
+            return await inter.response.send_message("Salon introuvable.", ephemeral=True)
+        uid = int(m[0])
+        members = getattr(room, self.list_name)
+        had = uid in members
+        if self.add: members.add(uid)
+        else: members.discard(uid)
+        def rollback():
+            if had: members.add(uid)
+            else: members.discard(uid)
+        await commit_room_access(inter, vc, room, rollback, self.done, touched=(uid,), reason=f"VC {self.list_name}")
+
+async def _set_room_private(inter: discord.Interaction, vc: discord.VoiceChannel, room: TempRoom, private: bool):
+    was, room.private = room.private, private
+    def rollback(): room.private = was
+    await commit_room_access(inter, vc, room, rollback, "Salon **privé**." if private else "Salon **public**.",
+                             reason="VC private" if private else "VC public")
+
+async def room_private(inter: discord.Interaction, vc: discord.VoiceChannel, room: TempRoom):
+    await _set_room_private(inter, vc, room, True)
+
+async def room_public(inter: discord.Interaction, vc: discord.VoiceChannel, room: TempRoom):
+    await _set_room_private(inter, vc, room, False)
+
+async def room_limit(inter: discord.Interaction, vc: discord.VoiceChannel, room: TempRoom):
+    await inter.response.send_modal(RoomLimitModal(vc.id))
+
+def room_list_action(list_name: str, add: bool, title: str, done: str):
+    async def action(inter: discord.Interaction, vc: discord.VoiceChannel, room: TempRoom):
+        await inter.response.send_modal(RoomListModal(vc.id, list_name, add, title, done))
+    return action
+
+async def room_lists(inter: discord.Interaction, vc: discord.VoiceChannel, room: TempRoom):
+    wl = ", ".join(f"<@{u}>" for u in room.whitelist) or "—"
+    bl = ", ".join(f"<@{u}>" for u in room.blacklist) or "—"
+    await inter.response.send_message(f"**Whitelist**: {wl}\n**Blacklist**: {bl}", ephemeral=True)
+
+ROOM_ACTIONS = {
+    "private": room_private,
+    "public":  room_public,
+    "limit":   room_limit,
+    "wl_add":  room_list_action("whitelist", True,  "Ajouter à la whitelist",  "Ajouté à la whitelist."),
+    "wl_del":  room_list_action("whitelist", False, "Retirer de la whitelist", "Retiré de la whitelist."),
+    "bl_add":  room_list_action("blacklist", True,  "Ajouter à la blacklist",  "Ajouté à la blacklist."),
+    "bl_del":  room_list_action("blacklist", False, "Retirer de la blacklist", "Retiré de la blacklist."),
+    "lists":   room_lists,
+}
+
+TEMP_VOICE_PREFIX = "🎤 Salon de "
+TEMP_TEXT_PREFIX  = "🔧-controle-"
+
+def forget_room(voice_id: int) -> Optional[TempRoom]:
+    room = temp_rooms.pop(voice_id, None)
+    room_reaper.cancel(voice_id)
+    state_store.delete(f"room:{voice_id}")
+    return room
+
+class TempRoomReaper:
+    """Suppression différée des salons temporaires vides : un tas d'échéances et une seule tâche.
+    Annulation O(1) (l'entrée du tas devient périmée), suppressions groupées via bulk_ops."""
+    def __init__(self, grace: float):
+        self.grace = grace
+        self.deadlines: Dict[int, float] = {}      # voice_id -> échéance en vigueur
+        self._heap: List[Tuple[float, int]] = []   # (échéance, voice_id) — entrées périmées ignorées
+        self._wake = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self.deadlines)
+
+    def schedule(self, voice_id: int, delay: Optional[float] = None):
+        exp = now() + (self.grace if delay is None else delay)
+        self.deadlines[voice_id] = exp
+        heapq.heappush(self._heap, (exp, voice_id))
+        if self._heap[0] == (exp, voice_id):
+            self._wake.set()   # nouvelle échéance la plus proche : on recale le réveil
+
+    def cancel(self, voice_id: int):
+        self.deadlines.pop(voice_id, None)
+
+    def due(self) -> List[int]:
+        t, out = now(), []
+        while self._heap and self._heap[0][0] <= t:
+            exp, vid = heapq.heappop(self._heap)
+            if self.deadlines.get(vid) == exp:
+                del self.deadlines[vid]
+                out.append(vid)
+        if len(self._heap) > 2 * len(self.deadlines) + 64:
+            self._heap = [(exp, vid) for vid, exp in self.deadlines.items()]
+            heapq.heapify(self._heap)
+        return out
+
+    async def run(self, client: commands.Bot):
+        while True:
+            timeout = max(0.0, self._heap[0][0] - now()) if self._heap else None
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            vids = self.due()
+            if vids:
+                try: await self.delete_rooms(client, vids)
+                except Exception: metrics.swallowed("room_reaper")
+
+    async def delete_rooms(self, client: commands.Bot, vids: Iterable[int]) -> BulkResult:
+        """Supprime vocal + contrôles ; un salon n'est oublié qu'une fois ses suppressions réussies,
+        sinon il est re-programmé (TEMP_DELETE_RETRY_S) avec son entrée temp_rooms intacte."""
+        async def delete(ch):
+            try: await ch.delete(reason="Salon temporaire vide")
+            except discord.NotFound: pass   # déjà supprimé : c'est le résultat voulu
+        jobs, owner, todo = [], {}, []
+        for vid in vids:
+            vc = client.get_channel(vid)
+            if vc is not None and vc.members:
+                continue   # réoccupé sans qu'on ait vu l'event : on garde
+            todo.append(vid)
+            room = temp_rooms.get(vid)
+            for ch in (vc, client.get_channel(room.text_id) if room else None):
+                if ch is not None:
+                    owner[ch.id] = vid
+                    jobs.append((ch.id, lambda ch=ch: delete(ch)))
+        res = await bulk_ops.run("channels", jobs)
+        retry = {owner[cid] for cid in res.failed}
+        for vid in todo:
+            if vid not in retry:
+                forget_room(vid)
+                continue
+            vc = client.get_channel(vid)
+            if vc is None or not vc.members:   # réoccupé entre-temps : on_voice_state_update a annulé
+                self.schedule(vid, TEMP_DELETE_RETRY_S)
+        return res
+
+room_reaper = TempRoomReaper(TEMP_DELETE_GRACE_S)
+
+TEMP_POOL_NAME = "🎤 Salon libre"
+
+class TempRoomPool:
+    """Mode rapide optionnel : salons vocaux cachés pré-créés dans TAVERNE. Les prendre coûte un seul
+    PATCH (nom + permissions de la catégorie) au lieu d'une création ; réassort en tâche de fond."""
+    def __init__(self, size: int):
+        self.size = size
+        self.idle: Dict[int, deque] = {}    # guild_id -> IDs de salons libres
+        self._refilling: Set[int] = set()
+
+    def adopt(self, guild: discord.Guild):
+        """Au démarrage : reprend les salons libres laissés par l'exécution précédente."""
+        q = self.idle.setdefault(guild.id, deque())
+        known = set(q)
+        q.extend(vc.id for vc in guild.voice_channels if vc.name == TEMP_POOL_NAME and vc.id not in known)
+
+    async def take(self, guild: discord.Guild, name: str) -> Optional[discord.VoiceChannel]:
+        q = self.idle.get(guild.id)
+        while q:
+            vc = guild.get_channel(q.popleft())
+            if vc is None or vc.members:   # occupé : jamais remis à quelqu'un d'autre
+                continue
+            try:
+                return await vc.edit(name=name, sync_permissions=True, reason="Salon temporaire") or vc
+            except Exception:
+                metrics.swallowed("room_pool")
+        return None
+
+    def refill_soon(self, guild: discord.Guild):
+        if self.size and guild.id not in self._refilling:
+            self._refilling.add(guild.id)
+            asyncio.create_task(self._refill(guild))
+
+    async def _refill(self, guild: discord.Guild):
+        try:
+            cat = commu_category(guild)
+            q = self.idle.setdefault(guild.id, deque())
+            while cat is not None and len(q) < self.size:
+                # Overwrites propres (pas celles de TAVERNE) : l'allow « Membre » l'emporterait sur le deny @everyone
+                ow = {guild.default_role: discord.PermissionOverwrite(view_channel=False, connect=False),
+                      guild.me: discord.PermissionOverwrite(view_channel=True, connect=True)}
+                vc = await guild.create_voice_channel(TEMP_POOL_NAME, category=cat, overwrites=ow, reason="Réserve de salons temporaires")
+                q.append(vc.id)
+        except Exception:
+            metrics.swallowed("room_pool")
+        finally:
+            self._refilling.discard(guild.id)
+
+room_pool = TempRoomPool(TEMP_ROOM_POOL_SIZE)
+
+async def sweep_orphan_rooms(client: commands.Bot) -> BulkResult:
+    """Au démarrage : salons 🎤/🔧 laissés par une exécution précédente sans entrée temp_rooms.
+    Vocaux occupés adoptés (sans propriétaire : contrôles staff), le reste supprimé."""
+    known_text = {room.text_id for room in temp_rooms.values()}
+    jobs = []
+    for g in client.guilds:
+        for vc in g.voice_channels:
+            if vc.id in temp_rooms or not vc.name.startswith(TEMP_VOICE_PREFIX):
+                continue
+            if vc.members:
+                room = temp_rooms[vc.id] = TempRoom(owner_id=0, voice_id=vc.id, text_id=0)
+                persist_room(room)
+            else:
+                jobs.append((vc.id, lambda ch=vc: ch.delete(reason="Salon temporaire orphelin")))
+        for txt in g.text_channels:
+            if txt.id not in known_text and txt.name.startswith(TEMP_TEXT_PREFIX):
+                jobs.append((txt.id, lambda ch=txt: ch.delete(reason="Contrôles de salon orphelins")))
+    return await bulk_ops.run("channels", jobs)
+
+# ===================== Setup : plan (diff) puis exécution parallèle =====================
+CAT_FUN_CHANNELS = [("🎭・conte-auteurs","text"), ("🎨・fan-art","text")]
+SETUP_LAYOUT = [
+    (CAT_WELCOME_NAME, WELCOME_CHANNELS, True),
+    (CAT_COMMU_NAME,   COMMU_CHANNELS,   False),
+    (CAT_FUN_NAME,     CAT_FUN_CHANNELS, False),
+    (CAT_PP_NAME,      PP_TEXT,          False),
+]
+
+@dataclass
+class SetupOp:
+    key: str                                        # identifiant (référencé par deps)
+    desc: str                                       # ligne affichée dans le plan
+    run: Callable[[Dict[str, Any]], Awaitable[Any]] # reçoit les résultats des ops déjà faites
+    deps: Tuple[str, ...] = ()
+    bucket: str = "channels"
+
+def plan_setup(guild: discord.Guild) -> List[SetupOp]:
+    """Compare l'état voulu à un instantané de la guilde (sans await) et liste les opérations manquantes.
+
+    Les salons d'une même catégorie sont chaînés (ordre d'affichage conservé), le reste est parallèle.
+    """
+    ops: List[SetupOp] = []
+    roles = {r.name: r for r in guild.roles}
+    cats = {c.name: c for c in guild.categories}
+
+    def role(ctx, name):
+        return ctx.get(f"role:{name}") or discord.utils.get(guild.roles, name=name)
+    def cat_of(ctx, name):
+        return ctx.get(f"cat:{name}") or category_by_name(guild, name)
+
+    # Rôles clés + sécurité
+    for name, perms in KEY_ROLE_PERMS.items():
+        r = roles.get(name)
+        if r is None:
+            ops.append(SetupOp(f"role:{name}", f"Créer le rôle {name}", bucket="roles",
+                run=lambda ctx, n=name, p=perms: guild.create_role(name=n, permissions=p, reason="Setup roles")))
+        elif r.permissions != perms:
+            ops.append(SetupOp(f"role:{name}", f"Mettre à jour les permissions de {name}", bucket="roles",
+                run=lambda ctx, r=r, p=perms: r.edit(permissions=p, reason="Update role perms")))
+    for name in (UNVERIFIED_ROLE_NAME, MEMBER_ROLE_NAME):
+        if name not in roles:
+            ops.append(SetupOp(f"role:{name}", f"Créer le rôle {name}", bucket="roles",
+                run=lambda ctx, n=name: guild.create_role(name=n, reason=f"Security: {n}")))
+
+    # Catégories + salons (chaînés par catégorie) + verrouillage
+    for cat_name, items, is_welcome in SETUP_LAYOUT:
+        cat = cats.get(cat_name)
+        if cat is None:
+            ops.append(SetupOp(f"cat:{cat_name}", f"Créer la catégorie {cat_name}",
+                run=lambda ctx, n=cat_name: guild.create_category(n, reason="Setup bot")))
+        exist = {c.name for c in cat.channels} if cat else set()
+        prev = f"cat:{cat_name}"
+        for nm, kind in items:
+            if nm in exist: continue
+            create = guild.create_text_channel if kind == "text" else guild.create_voice_channel
+            ops.append(SetupOp(f"ch:{cat_name}:{nm}", f"Créer #{nm} dans {cat_name}", deps=(prev,),
+                run=lambda ctx, c=create, n=nm, cn=cat_name: c(n, category=cat_of(ctx, cn))))
+            prev = f"ch:{cat_name}:{nm}"
+
+        unv, mem = roles.get(UNVERIFIED_ROLE_NAME), roles.get(MEMBER_ROLE_NAME)
+        if cat and unv and mem:
+            ow = cat.overwrites
+            want = {guild.default_role: discord.PermissionOverwrite(view_channel=False),
+                    mem: discord.PermissionOverwrite(view_channel=True),
+                    unv: discord.PermissionOverwrite(view_channel=is_welcome, send_messages=is_welcome)}
+            if all(ow.get(t) == o for t, o in want.items()):
+                continue
+        ops.append(SetupOp(f"lock:{cat_name}", f"Verrouiller {cat_name} (sécurité)",
+            deps=(f"cat:{cat_name}", f"role:{UNVERIFIED_ROLE_NAME}", f"role:{MEMBER_ROLE_NAME}"),
+            run=lambda ctx, cn=cat_name, w=is_welcome: lock_category(
+                cat_of(ctx, cn), guild.default_role, role(ctx, UNVERIFIED_ROLE_NAME), role(ctx, MEMBER_ROLE_NAME), is_welcome=w)))
+
+    # Vocaux PP : créateur puis Préparation i / Attaque / Défense, une seule chaîne (positions)
+    pp = cats.get(CAT_PP_NAME)
+    prev = f"cat:{CAT_PP_NAME}"
+    def voice_op(key, desc, name, limit, existing):
+        nonlocal prev
+        if existing is None:
+            ops.append(SetupOp(key, desc, deps=(prev,),
+                run=lambda ctx: guild.create_voice_channel(name, category=cat_of(ctx, CAT_PP_NAME), user_limit=limit)))
+            prev = key
+        elif limit is not None and existing.user_limit != limit:
+            ops.append(SetupOp(key, f"Limiter {existing.name} à {limit}", run=lambda ctx: existing.edit(user_limit=limit)))
+    creator = discord.utils.get(pp.voice_channels, name=CREATE_VOICE_NAME) if pp else None
+    voice_op("voice:creator", f"Créer {CREATE_VOICE_NAME}", CREATE_VOICE_NAME, None, creator)
+    for i in range(1, PREP_SETS_MIN+1):
+        prep, atk, defn = find_group_channels_for_set(guild, i) if pp else (None, None, None)
+        voice_op(f"voice:prep:{i}", f"Créer Préparation {i}", f"Préparation {i}", PREP_VOICE_LIMIT, prep)
+        voice_op(f"voice:atk:{i}", f"Créer Attaque (set {i})", "⚔ · Attaque", SIDE_VOICE_LIMIT, atk if prep else None)
+        voice_op(f"voice:def:{i}", f"Créer Défense (set {i})", "🛡 · Défense", SIDE_VOICE_LIMIT, defn if prep else None)
+
+    # Salons-partie (à la suite des textes PP) puis panneaux
+    prev = next((op.key for op in reversed(ops) if op.key.startswith(f"ch:{CAT_PP_NAME}:")), f"cat:{CAT_PP_NAME}")
+    for i in range(1, PREP_SETS_MIN+1):
+        chat = get_party_text_channel(guild, i) if pp else None
+        key = f"party:{i}"
+        if chat is None:
+            ops.append(SetupOp(key, f"Créer • salon-partie-{i}", deps=(prev,),
+                run=lambda ctx, i=i: guild.create_text_channel(f"• salon-partie-{i}", category=cat_of(ctx, CAT_PP_NAME), reason="PP party chat")))
+            prev = key
+        # Panneaux connus du registre dans ce salon : rien à faire ; sinon vérification à l'exécution
+        if panel_registry.has(chat, "panel", i) and panel_registry.has(chat, "mapvote", i):
+            continue
+        async def panels(ctx, i=i, key=key):
+            ch = ctx.get(key) or get_party_text_channel(guild, i)
+            await ensure_panel_once(ch, i)
+            await ensure_mapvote_panel_once(ch, i)
+        ops.append(SetupOp(f"panel:{i}", f"Vérifier/poser les panneaux du set {i}", deps=(key,), bucket="messages", run=panels))
+
+    # Messages : peak ELO, règles (mêmes règles que les panneaux) ; branding
+    welcome_deps = tuple(f"ch:{CAT_WELCOME_NAME}:{nm}" for nm, _ in WELCOME_CHANNELS)
+    welcome = cats.get(CAT_WELCOME_NAME)
+    autoroles = (find_text_by_slug(welcome, "auto rôles") or find_text_by_slug(welcome, "auto-roles")) if welcome else None
+    if not panel_registry.has(autoroles, "rank"):
+        async def rank_prompt(ctx):
+            await ensure_rank_prompt_in_autoroles(guild, cat_of(ctx, CAT_WELCOME_NAME))
+        ops.append(SetupOp("msg:rank", "Vérifier/poser le bouton peak ELO", deps=welcome_deps, bucket="messages", run=rank_prompt))
+    reg1 = find_text_by_slug(welcome, "règlement") if welcome else None
+    reg2 = find_text_by_slug(pp, "règlement pp") if pp else None
+    if not (panel_registry.has(reg1, "rules") and panel_registry.has(reg2, "rules_pp")):
+        async def rules(ctx):
+            reg1 = find_text_by_slug(cat_of(ctx, CAT_WELCOME_NAME), "règlement")
+            if reg1: await post_server_rules(reg1)
+            reg2 = find_text_by_slug(cat_of(ctx, CAT_PP_NAME), "règlement pp")
+            if reg2: await post_rules_pp(reg2)
+        ops.append(SetupOp("msg:rules", "Vérifier/épingler les règlements",
+            deps=welcome_deps + tuple(f"ch:{CAT_PP_NAME}:{nm}" for nm, _ in PP_TEXT), bucket="messages", run=rules))
+    bienv = find_text_by_slug(cats[CAT_WELCOME_NAME], "bienvenue") if CAT_WELCOME_NAME in cats else None
+    if guild.name != SERVER_BRAND_NAME or bienv is None or guild.system_channel != bienv:
+        async def branding(ctx):
+            ch = find_text_by_slug(cat_of(ctx, CAT_WELCOME_NAME), "bienvenue")
+            await guild.edit(name=SERVER_BRAND_NAME, system_channel=ch or guild.system_channel)
+        ops.append(SetupOp("guild:brand", f"Renommer le serveur en {SERVER_BRAND_NAME}", deps=welcome_deps, bucket="guild", run=branding))
+    if guild.me and guild.me.nick != BOT_NICKNAME:
+        ops.append(SetupOp("guild:nick", f"Surnom du bot : {BOT_NICKNAME}", bucket="guild",
+            run=lambda ctx: guild.me.edit(nick=BOT_NICKNAME, reason="Brand nickname")))
+    return ops
+
+async def run_setup_plan(ops: List[SetupOp]) -> Tuple[List[str], List[str]]:
+    """Exécute le plan : chaque op attend ses dépendances, puis passe par le bucket de rate-limit.
+    Une op dont une dépendance a échoué est sautée. Retourne (faites, échouées/sautées)."""
+    loop = asyncio.get_running_loop()
+    done_f = {op.key: loop.create_future() for op in ops}
+    ctx: Dict[str, Any] = {}
+    ok: List[str] = []; failed: List[str] = []
+    async def one(op: SetupOp):
+        success = False
+        try:
+            if all([await done_f[d] for d in op.deps if d in done_f]):
+                async with bulk_ops.semaphore(op.bucket):
+                    ctx[op.key] = await op.run(ctx)
+                success = True
+        except Exception:
+            metrics.swallowed()
+        (ok if success else failed).append(op.desc)
+        done_f[op.key].set_result(success)
+    await asyncio.gather(*(one(op) for op in ops))
+    return ok, failed
+
+def chunk_lines(lines: List[str], limit: int = 1900) -> List[str]:
+    out, cur = [], ""
+    for ln in lines:
+        if len(cur) + len(ln) + 1 > limit:
+            out.append(cur); cur = ""
+        cur += ln + "\n"
+    if cur: out.append(cur)
+    return out
 
 # ===================== Bot / setup_hook =====================
+def restore_state(data: Dict[str, Any]):
+    """Réhydrate files, votes, URLs des images de maps et salons temporaires depuis le chargement SQLite."""
+    for key, val in data.items():
+        kind, _, ident = key.partition(":")
+        try:
+            if kind == "queue":
+                set_queues.load(int(ident), (int(u) for u in val))
+            elif kind == "mapvote":
+                map_votes[int(ident)] = load_mapvote(val)
+            elif kind == "mapimg":
+                map_assets.urls[ident] = val
+            elif kind == "mapmsg":
+                map_assets.messages[ident] = int(val)
+            elif kind == "panelmsg":
+                panel_registry.entries[key] = tuple(val)
+            elif kind == "room":
+                room = load_room(val)
+                temp_rooms[room.voice_id] = room
+        except Exception:
+            state_store.delete(key)
+
+def reconcile_state(client: commands.Bot):
+    """Confronte l'état restauré à la guilde réelle : salons disparus oubliés, salons vides re-programmés."""
+    for vid, room in list(temp_rooms.items()):
+        vc = client.get_channel(vid)
+        if vc is None:
+            forget_room(vid)
+        elif len(vc.members) == 0:
+            room_reaper.schedule(vid)   # vidé pendant l'arrêt : délai de grâce normal
+    for i, q in set_queues.queues.items():
+        gone = [u for u in q if not any(g.get_member(u) for g in client.guilds)]
+        for u in gone: set_queues.leave(i, u)
+
+def app_command_done(inter: discord.Interaction, command: str, error: Optional[Exception] = None):
+    """Arrête le chrono posé par TimedCommandTree.interaction_check (succès ou erreur)."""
+    t = inter.extras.pop("timer", None)
+    if t is not None:
+        t.labels["command"] = command
+        t.__exit__(type(error) if error else None, error, None)
+
+class TimedCommandTree(app_commands.CommandTree):
+    """Commandes slash chronométrées autour du callback lui-même (checks compris), pas depuis created_at :
+    ni délai de livraison gateway ni décalage d'horloge, et les commandes en erreur sont mesurées aussi."""
+    async def interaction_check(self, inter: discord.Interaction) -> bool:
+        if inter.type == discord.InteractionType.application_command:
+            name = (inter.data or {}).get("name", "?")
+            inter.extras["timer"] = metrics.timer("app_command_seconds", context=f"/{name}", command=name).__enter__()
+        return True
+
+    async def on_error(self, inter: discord.Interaction, error: app_commands.AppCommandError):
+        cmd = inter.command.qualified_name if inter.command else "?"
+        metrics.inc("app_command_errors_total", command=cmd, error=type(error).__name__)
+        app_command_done(inter, cmd, error)
+        await super().on_error(inter, error)
+
 class FiveBot(commands.Bot):
-    def __init__(self): super().__init__(command_prefix="!", intents=INTENTS)
+    def __init__(self):
+        super().__init__(command_prefix="!", intents=INTENTS, http_trace=metrics.http_trace(), tree_cls=TimedCommandTree)
+        self.state_reconciled = False
     async def setup_hook(self):
-        # Vues persistantes
-        for i in range(1, PREP_PAIRS+1):
-            self.add_view(PanelView(i))
-            self.add_view(MapVoteView(i))
+        # État persistant (un seul chargement) + écriture différée
+        restore_state(await state_store.load())
+        self.state_flusher = asyncio.create_task(state_store.flusher(STATE_FLUSH_S))
+        # Images des maps : lecture + redimensionnement une fois (hors boucle)
+        await asyncio.get_running_loop().run_in_executor(None, map_assets.preload)
+        # Vues persistantes (panneaux 5v5 / roulette / salons temporaires : routeurs par custom_id, voir sets_router / rooms_router)
         self.add_view(RankButtonView())
+        self.set_reaper = asyncio.create_task(set_reaper(self))
+        self.room_reaper = asyncio.create_task(room_reaper.run(self))
+        # Réserve de CAPTCHA pré-rendus
+        self.captcha_refill = asyncio.create_task(captcha_pool.refill_loop(captcha_renderer))
+        self.captcha_sweeper = asyncio.create_task(_captcha_store.sweeper(CAPTCHA_SWEEP_EVERY))
+        # Chien de garde de la boucle (retard, blocages, callbacks lents : voir /slow_report)
+        metrics.watchdog.start()
+        # Santé / métriques HTTP sur la même boucle (si PORT défini)
+        try:
+            self.http_runner = await keep_alive(self)
+        except Exception as e:
+            self.http_runner = None
+            print(f"[keep_alive] disabled: {e}")
         # Sync tree
         if GUILD_ID:
             gid=int(GUILD_ID)
@@ -988,6 +2250,14 @@ class FiveBot(commands.Bot):
         else:
             await self.tree.sync()
 
+    async def close(self):
+        try: await state_store.close()
+        except Exception: metrics.swallowed()
+        if getattr(self, "http_runner", None):
+            try: await self.http_runner.cleanup()
+            except Exception: metrics.swallowed()
+        await super().close()
+
 bot = FiveBot()
 
 # ===================== CAPTCHA router & /verify (après bot = ...) =====================
@@ -1004,50 +2274,250 @@ async def captcha_router(inter: discord.Interaction):
             return
         _, action, uid_s, tag = parts
         uid = int(uid_s)
+        with metrics.timer("interaction_seconds", context=cid, handler=f"cap:{action}"):
+            await captcha_action(inter, action, uid, tag)
+    except Exception:
+        metrics.swallowed("captcha_router")
 
-        if action == "start":
-            if htag(f"start:{uid}") != tag or inter.user.id != uid:
-                return
+async def captcha_action(inter: discord.Interaction, action: str, uid: int, tag: str):
+    """cap:start:<uid>:<tag> (envoie l'image) et cap:answer:<uid>:<tag> (ouvre le modal)."""
+    if action == "start":
+        if htag(f"start:{uid}") != tag or inter.user.id != uid:
+            return
+        warm = captcha_pool.pop()
+        if warm:
+            code, render = warm[0], None
+        else:
             code = rand_text(CAPTCHA_CODE_LEN)
-            pos = pick_positions(CAPTCHA_CODE_LEN, 3)
-            expected = subseq(code, pos)
-            _captcha_store[uid] = {
-                "code": code, "expected": expected, "pos": pos,
-                "tries": 0, "started": time.time(), "last": 0,
-                "ttl": time.time() + CAPTCHA_TTL_SECONDS,
-            }
-            img = build_captcha_image(code)
-            file = discord.File(io.BytesIO(img), filename="captcha.png")
-            pos_txt = ", ".join(f"#{p}" for p in pos)
-            emb = discord.Embed(
-                title="Recopie uniquement ces positions",
-                description=f"Écris **{pos_txt}** du code affiché.",
-                color=0x2ecc71
-            )
-            emb.set_image(url="attachment://captcha.png")
-            v = discord.ui.View()
-            v.add_item(discord.ui.Button(
-                label="✍️ Répondre",
-                style=discord.ButtonStyle.success,
-                custom_id=f"cap:answer:{uid}:{htag(f'answer:{uid}')}"
-            ))
-            return await inter.response.send_message(embed=emb, file=file, view=v, ephemeral=True)
-
-        elif action == "answer":
-            if htag(f"answer:{uid}") != tag or inter.user.id != uid:
-                return
-            return await inter.response.send_modal(CaptchaModal(uid))
+            render = captcha_renderer.submit(code)
+            if render is None:
+                return await inter.response.send_message(CAPTCHA_BUSY_TEXT, ephemeral=True)
+        pos = pick_positions(CAPTCHA_CODE_LEN, 3)
+        expected = subseq(code, pos)
+        _captcha_store[uid] = {
+            "code": code, "expected": expected, "pos": pos,
+            "tries": 0, "started": time.time(), "last": 0,
+            "ttl": time.time() + CAPTCHA_TTL_SECONDS,
+        }
+        deferred = False
+        if render is None:
+            img = warm[1]
+        else:
+            done, _ = await asyncio.wait({render}, timeout=CAPTCHA_DEFER_AFTER)
+            deferred = not done
+            if deferred:
+                await inter.response.defer(ephemeral=True)
+            img = await render
+        file = discord.File(io.BytesIO(img), filename="captcha.png")
+        pos_txt = ", ".join(f"#{p}" for p in pos)
+        emb = discord.Embed(
+            title="Recopie uniquement ces positions",
+            description=f"Écris **{pos_txt}** du code affiché.",
+            color=0x2ecc71
+        )
+        emb.set_image(url="attachment://captcha.png")
+        v = discord.ui.View()
+        v.add_item(discord.ui.Button(
+            label="✍️ Répondre",
+            style=discord.ButtonStyle.success,
+            custom_id=f"cap:answer:{uid}:{htag(f'answer:{uid}')}"
+        ))
+        if deferred:
+            return await inter.followup.send(embed=emb, file=file, view=v, ephemeral=True)
+        return await inter.response.send_message(embed=emb, file=file, view=v, ephemeral=True)
+
+    elif action == "answer":
+        if htag(f"answer:{uid}") != tag or inter.user.id != uid:
+            return
+        return await inter.response.send_modal(CaptchaModal(uid))
+
+# ===================== Routeur panneaux 5v5 / roulette map =====================
+SET_ROUTES = {"panel": PANEL_ACTIONS, "mapvote": MAPVOTE_ACTIONS}
 
+@bot.listen("on_interaction")
+async def sets_router(inter: discord.Interaction):
+    """Un seul point d'entrée pour panel:<action>:<set> et mapvote:<action>:<set>, quel que soit le nombre de sets."""
+    try:
+        if inter.type != discord.InteractionType.component:
+            return
+        cid = inter.data.get("custom_id","")
+        kind, _, rest = cid.partition(":")
+        actions = SET_ROUTES.get(kind)
+        if actions is None:
+            return
+        action, _, idx = rest.partition(":")
+        handler = actions.get(action)
+        if handler is None or not idx.isdigit():
+            return
+        with metrics.timer("interaction_seconds", context=cid, handler=f"{kind}:{action}"):
+            await handler(inter, int(idx))
     except Exception:
-        pass
+        metrics.swallowed("sets_router")
+
+# ---------- Commandes slash : durée du callback (erreurs : TimedCommandTree.on_error) ----------
+@bot.listen("on_app_command_completion")
+async def app_command_timing(inter: discord.Interaction, command):
+    app_command_done(inter, command.qualified_name)
+
+# ===================== Routeur contrôles des salons temporaires =====================
+@bot.listen("on_interaction")
+async def rooms_router(inter: discord.Interaction):
+    """vc:<action>:<voice_id>:<tag> : état lu dans temp_rooms (persisté), aucune vue par salon, survit aux redémarrages."""
+    try:
+        if inter.type != discord.InteractionType.component:
+            return
+        cid = inter.data.get("custom_id","")
+        if not cid.startswith("vc:"):
+            return
+        parts = cid.split(":")
+        if len(parts) == 4:
+            _, action, vid_s, tag = parts
+            if not vid_s.isdigit():
+                return
+            if not hmac.compare_digest(htag(f"vc:{action}:{vid_s}"), tag):
+                return await inter.response.send_message(
+                    f"Ces contrôles ont expiré. Recrée un salon via **{CREATE_VOICE_NAME}**.", ephemeral=True)
+            room = temp_rooms.get(int(vid_s))
+        elif len(parts) == 2:
+            # Anciens messages (custom_id statique vc:<action>) : salon retrouvé par son salon de contrôle
+            action = parts[1]
+            room = next((r for r in temp_rooms.values() if r.text_id == inter.channel_id), None)
+        else:
+            return
+        handler = ROOM_ACTIONS.get(action)
+        if handler is None:
+            return
+        with metrics.timer("interaction_seconds", context=cid, handler=f"vc:{action}"):
+            vc = inter.guild.get_channel(room.voice_id) if room else None
+            if vc is None:
+                return await inter.response.send_message("Salon introuvable.", ephemeral=True)
+            if action not in ROOM_OPEN_ACTIONS and not staff_or_owner(inter.user, room):
+                return await inter.response.send_message("Réservé au créateur/Orga PP.", ephemeral=True)
+            await handler(inter, vc, room)
+    except Exception:
+        metrics.swallowed("rooms_router")
 
 @bot.tree.command(description="Relancer la vérification (si tu n'as pas pu la faire).")
 async def verify(interaction: discord.Interaction):
+    if captcha_renderer.full() and not len(captcha_pool):
+        return await interaction.response.send_message(CAPTCHA_BUSY_TEXT, ephemeral=True)
     await interaction.response.defer(ephemeral=True)
     await send_captcha(interaction.guild, interaction.user)
     await interaction.followup.send("Vérification envoyée (DM ou salon bienvenue).", ephemeral=True)
 
+@bot.tree.command(description="(Staff) Statistiques de la réserve de CAPTCHA pré-rendus.")
+@app_commands.checks.has_permissions(manage_guild=True)
+async def captcha_stats(interaction: discord.Interaction):
+    total = captcha_pool.hits + captcha_pool.misses
+    rate = f"{100*captcha_pool.hits/total:.0f}%" if total else "—"
+    await interaction.response.send_message(
+        f"Réserve : **{len(captcha_pool)}/{captcha_pool.target}** • "
+        f"hits **{captcha_pool.hits}** • misses **{captcha_pool.misses}** (taux {rate}) • "
+        f"rendus en cours **{captcha_renderer.pending}/{captcha_renderer.max_pending}**",
+        ephemeral=True
+    )
+
+@bot.tree.command(description="(Staff) Callbacks lents et blocages récents de la boucle.")
+@app_commands.checks.has_permissions(manage_guild=True)
+async def slow_report(interaction: discord.Interaction):
+    wd = metrics.watchdog
+    events = list(wd.events)
+    lines = [f"Boucle : retard **{wd.lag*1000:.0f} ms** (max **{wd.max_lag*1000:.0f} ms**) • "
+             f"seuils : callback {metrics.SLOW_CALLBACK_S*1000:.0f} ms, blocage {wd.block_after*1000:.0f} ms"]
+    if not events:
+        lines.append("Aucun événement lent enregistré.")
+        return await interaction.response.send_message("\n".join(lines), ephemeral=True)
+    # Agrégat par (type, handler) : nombre, pire durée, dernier custom_id
+    agg: Dict[Tuple[str, str], List[Any]] = {}
+    for ev in events:
+        a = agg.setdefault((ev.kind, ev.handler), [0, 0.0, ""])
+        a[0] += 1; a[1] = max(a[1], ev.duration); a[2] = ev.custom_id or a[2]
+    for (kind, handler), (n, worst, cid) in sorted(agg.items(), key=lambda kv: -kv[1][1])[:10]:
+        what = "🧊 bloquée" if kind == "blocked" else "🐢 lent"
+        lines.append(f"{what} `{handler}` ×{n} • max **{worst*1000:.0f} ms**" + (f" • `{cid}`" if cid else ""))
+    last = next((ev for ev in reversed(events) if ev.stack), None)
+    if last:
+        head = f"Dernière pile ({last.kind}, `{last.handler}`, {last.duration*1000:.0f} ms) :"
+        room = 1900 - sum(len(l) + 1 for l in lines) - len(head)
+        if room > 100:
+            lines += [head, "```py\n" + last.stack[-(room - 10):] + "```"]
+    await interaction.response.send_message("\n".join(lines), ephemeral=True)
+
 # ===================== Events =====================
+@bot.listen("on_ready")
+async def reset_channel_indexes():
+    # Après une reconnexion des events ont pu être manqués : on repart d'index vides
+    _channel_indexes.clear()
+
+@bot.listen("on_ready")
+async def reconcile_on_ready():
+    if not bot.state_reconciled:
+        bot.state_reconciled = True
+        reconcile_state(bot)
+        await sweep_orphan_rooms(bot)
+        for g in bot.guilds:
+            room_pool.adopt(g)
+            room_pool.refill_soon(g)
+    for g in bot.guilds:
+        if pp_category(g):
+            map_assets.ensure_uploaded(g)
+            break
+
+@bot.listen("on_member_update")
+async def track_member_rank(before: discord.Member, after: discord.Member):
+    if before.roles != after.roles:
+        refresh_peak_rank(after)
+
+@bot.listen("on_member_remove")
+async def forget_member_rank(member: discord.Member):
+    member_ranks.pop((member.guild.id, member.id), None)
+    _mention_cache.pop((member.guild.id, member.id), None)
+
+def _forget_guild_ranks(guild: discord.Guild):
+    for key in [k for k in member_ranks if k[0] == guild.id]:
+        member_ranks.pop(key, None)
+
+@bot.listen("on_guild_role_update")
+async def rank_role_renamed(before: discord.Role, after: discord.Role):
+    if before.name != after.name:
+        _forget_guild_ranks(after.guild)
+
+@bot.listen("on_guild_role_delete")
+async def rank_role_deleted(role: discord.Role):
+    if is_rank_role_name(role.name):
+        _forget_guild_ranks(role.guild)
+
+@bot.listen("on_guild_channel_create")
+async def index_channel_create(channel: discord.abc.GuildChannel):
+    channel_index(channel.guild).invalidate(channel)
+
+@bot.listen("on_guild_channel_delete")
+async def index_channel_delete(channel: discord.abc.GuildChannel):
+    channel_index(channel.guild).invalidate(channel)
+    party_tracker.take(channel.id); party_tracker.clean.discard(channel.id)
+
+@bot.listen("on_message")
+async def track_party_message(message: discord.Message):
+    guild = message.guild
+    cat = pp_category(guild) if guild else None
+    if cat is None or getattr(message.channel, "category_id", None) != cat.id:
+        return   # hors catégorie PP : aucun calcul par message
+    if message.channel.id in party_channel_ids(guild):
+        party_tracker.track(message.channel.id, message.id)
+
+@bot.listen("on_raw_message_delete")
+async def untrack_party_message(payload: discord.RawMessageDeleteEvent):
+    party_tracker.untrack(payload.channel_id, (payload.message_id,))
+
+@bot.listen("on_raw_bulk_message_delete")
+async def untrack_party_messages(payload: discord.RawBulkMessageDeleteEvent):
+    party_tracker.untrack(payload.channel_id, payload.message_ids)
+
+@bot.listen("on_guild_channel_update")
+async def index_channel_update(before: discord.abc.GuildChannel, after: discord.abc.GuildChannel):
+    idx = channel_index(after.guild)
+    idx.invalidate(before); idx.invalidate(after)
+
 @bot.event
 async def on_member_join(member: discord.Member):
     # Rôles sécurité
@@ -1065,7 +2535,7 @@ async def on_member_join(member: discord.Member):
 
     # Ping visible dans auto-rôles
     try:
-        cat = discord.utils.get(member.guild.categories, name=CAT_WELCOME_NAME)
+        cat = category_by_name(member.guild, CAT_WELCOME_NAME)
         if cat:
             ch = find_text_by_slug(cat, "auto rôles") or find_text_by_slug(cat, "auto-roles")
             if ch and ch.permissions_for(member.guild.me).send_messages:
@@ -1074,114 +2544,121 @@ async def on_member_join(member: discord.Member):
                     f"Et pense à **🎯 Déclarer ton peak ELO** juste après !"
                 )
     except Exception:
-        pass
+        metrics.swallowed()
 
-@bot.event
-async def on_voice_state_update(member:discord.Member, before:discord.VoiceState, after:discord.VoiceState):
+def room_denies(room: TempRoom, member: discord.Member) -> bool:
+    """Blacklist + salon privé en une passe ; guild_permissions (coûteux) seulement si refus."""
+    uid = member.id
+    denied = uid in room.blacklist or (room.private and uid != room.owner_id and uid not in room.whitelist)
+    return denied and not member.guild_permissions.administrator
+
+_room_creations: Set[int] = set()   # membres dont le salon est en cours de création (dédup des rebonds)
+
+async def create_temp_room(member: discord.Member, creator: discord.VoiceChannel):
+    """Chemin critique : salon vocal (réserve ou création) puis déplacement du membre.
+    Le salon de contrôle et son message sont créés en parallèle, hors du chemin critique."""
     guild = member.guild
-    # Création auto dans 🍻・TAVERNE
-    if after and after.channel and after.channel.name == CREATE_VOICE_NAME:
-        cat = commu_category(guild) or after.channel.category  # 👉 TAVERNE prioritaire
-        vc = await guild.create_voice_channel(f"🎤 Salon de {member.display_name}", category=cat)
-        txt = await guild.create_text_channel(f"🔧-controle-{member.name}".lower(), category=cat, overwrites={
+    if member.id in _room_creations:
+        return
+    own = next((r for r in temp_rooms.values() if r.owner_id == member.id and guild.get_channel(r.voice_id)), None)
+    if own is not None:
+        # Il a déjà un salon : on l'y renvoie plutôt que d'en créer un second
+        try: await member.move_to(guild.get_channel(own.voice_id))
+        except Exception: metrics.swallowed()
+        return
+    _room_creations.add(member.id)
+    try:
+        cat = commu_category(guild) or creator.category  # 👉 TAVERNE prioritaire
+        name = f"{TEMP_VOICE_PREFIX}{member.display_name}"
+        vc = await room_pool.take(guild, name) or await guild.create_voice_channel(name, category=cat)
+        room = temp_rooms[vc.id] = TempRoom(owner_id=member.id, voice_id=vc.id, text_id=0)
+        persist_room(room)
+        controls = asyncio.create_task(create_room_controls(member, vc, room, cat))
+        try:
+            await member.move_to(vc)
+        except Exception:
+            metrics.swallowed()
+            room_reaper.schedule(vc.id)   # parti entre-temps : salon vide, suppression différée
+        await controls
+    finally:
+        _room_creations.discard(member.id)
+    room_pool.refill_soon(guild)
+
+async def create_room_controls(member: discord.Member, vc: discord.VoiceChannel, room: TempRoom, cat: Optional[discord.CategoryChannel]):
+    guild = member.guild
+    try:
+        txt = await guild.create_text_channel(f"{TEMP_TEXT_PREFIX}{member.name}".lower(), category=cat, overwrites={
             guild.default_role: discord.PermissionOverwrite(read_messages=False),
             member: discord.PermissionOverwrite(read_messages=True, send_messages=True),
             guild.me: discord.PermissionOverwrite(read_messages=True, send_messages=True),
         })
-        try: await member.move_to(vc)
-        except: pass
-        room = TempRoom(owner_id=member.id, voice_id=vc.id, text_id=txt.id)
-        temp_rooms[vc.id] = room
-        view = VoiceControlView(room)
-        await txt.send(f"{member.mention}, voici les contrôles de **ton** salon :", view=view)
-
-    # Timer suppression si vide
-    if before and before.channel and before.channel.id in temp_rooms:
-        vc = before.channel
-        if len(vc.members) == 0:
-            if vc.id in delete_tasks and not delete_tasks[vc.id].done():
-                delete_tasks[vc.id].cancel()
-            delete_tasks[vc.id] = asyncio.create_task(start_delete_timer(guild, vc.id))
-
-    # WL/BL + privé
-    if after and after.channel and after.channel.id in temp_rooms:
-        room = temp_rooms[after.channel.id]
-        if member.id in room.blacklist and not member.guild_permissions.administrator:
-            try: await member.move_to(None)
-            except: pass
-        if room.private and member.id not in room.whitelist and member.id != room.owner_id and not member.guild_permissions.administrator:
+    except Exception:
+        return metrics.swallowed("room_controls")
+    if temp_rooms.get(vc.id) is not room:
+        # Salon déjà supprimé pendant la création du contrôle
+        try: await txt.delete(reason="Salon temporaire supprimé")
+        except Exception: metrics.swallowed()
+        return
+    room.text_id = txt.id
+    persist_room(room)
+    try: await txt.send(f"{member.mention}, voici les contrôles de **ton** salon :", view=VoiceControlView(room))
+    except Exception: metrics.swallowed("room_controls")
+
+@bot.event
+async def on_voice_state_update(member:discord.Member, before:discord.VoiceState, after:discord.VoiceState):
+    left, joined = before.channel, after.channel
+    if left == joined:
+        return   # mute / sourdine / stream / vidéo : pas de changement de salon
+    # Création auto dans 🍻・TAVERNE (salon créateur reconnu par ID)
+    if joined is not None and joined.id == channel_index(member.guild).creator_id(member.guild):
+        await create_temp_room(member, joined)
+
+    # Suppression différée si vide / annulée si quelqu'un revient
+    if left is not None and left.id in temp_rooms and not left.members:
+        room_reaper.schedule(left.id)
+
+    # WL/BL + privé : normalement refusé par les overwrites (apply_room_access) ; filet de sécurité
+    room = temp_rooms.get(joined.id) if joined is not None else None
+    if room is not None:
+        room_reaper.cancel(joined.id)
+        if room_denies(room, member):
             try: await member.move_to(None)
-            except: pass
+            except Exception: metrics.swallowed()
 
 # ===================== Slash Commands =====================
 @bot.tree.command(description="Configurer tout le serveur (sans doublons).")
 @app_commands.checks.has_permissions(manage_guild=True)
-async def setup(inter:discord.Interaction):
+@app_commands.describe(dry_run="Afficher seulement le plan, sans rien modifier")
+async def setup(inter:discord.Interaction, dry_run:bool=False):
     await inter.response.defer(ephemeral=True, thinking=True)
     g=inter.guild
 
-    await ensure_roles(g)
-    cat_welcome = await create_category_with_channels(g, CAT_WELCOME_NAME, WELCOME_CHANNELS)
-    cat_commu   = await create_category_with_channels(g, CAT_COMMU_NAME,   COMMU_CHANNELS)
-    cat_fun     = await create_category_with_channels(g, CAT_FUN_NAME,     [("🎭・conte-auteurs","text"), ("🎨・fan-art","text")])
-    cat_pp      = await create_category_with_channels(g, CAT_PP_NAME,      PP_TEXT)
-
-    # Sécurité (catégories)
-    await apply_security_perms(g)
-
-    # Créateur de salons (dans PP, le bouton d'entrée)
-    if not discord.utils.find(lambda c: c.name==CREATE_VOICE_NAME, cat_pp.voice_channels):
-        await g.create_voice_channel(CREATE_VOICE_NAME, category=cat_pp)
-
-    # Vocs PP + textes • salon-partie-1..4
-    await create_pp_voice_structure(g, cat_pp)
-    await ensure_party_text_channels(g, cat_pp, count=PREP_PAIRS)
+    ops = plan_setup(g)
+    if dry_run:
+        lines = [f"• {op.desc}" for op in ops] or ["Rien à faire : le serveur est déjà conforme."]
+        for part in chunk_lines([f"🧭 Plan /setup ({len(ops)} opérations) :"] + lines):
+            await inter.followup.send(part, ephemeral=True)
+        return
 
-    # Panneaux : file 5v5 + roulette map (détection robuste des salons-partie)
-    for i in range(1, PREP_PAIRS+1):
-        chat = get_party_text_channel(g, i)
-        if not chat:
-            continue
-        await ensure_panel_once(chat, panel_embed(g, i), PanelView(i))
-        await ensure_mapvote_panel_once(chat, i)
-
-    # Peak ELO dans auto-rôles
-    await ensure_rank_prompt_in_autoroles(g, cat_welcome)
-
-    # Branding
-    try:
-        bienv = find_text_by_slug(cat_welcome, "bienvenue")
-        await g.edit(name=SERVER_BRAND_NAME, system_channel=bienv or g.system_channel)
-    except: pass
-    try:
-        me=g.me
-        if me and me.nick!=BOT_NICKNAME:
-            await me.edit(nick=BOT_NICKNAME, reason="Brand nickname")
-    except: pass
-
-    # Règles (post & pin si pas déjà)
-    try:
-        reg1 = find_text_by_slug(cat_welcome,"règlement")
-        if reg1: await post_server_rules(reg1)
-        reg2 = find_text_by_slug(cat_pp,"règlement-pp")
-        if reg2: await post_rules_pp(reg2)
-    except: pass
-
-    await inter.followup.send("✅ Setup terminé : panels 5v5 + roulette map dans `• salon-partie-1..4`, bouton peak ELO dans `🪙・auto-rôles`, créateur de salon vocal opérationnel (création dans 🍻・TAVERNE).", ephemeral=True)
+    ok, failed = await run_setup_plan(ops)
+    text = [f"✅ Setup terminé ({len(ok)}/{len(ops)} opérations) : panels 5v5 + roulette map dans `• salon-partie-1..{PREP_SETS_MIN}`, bouton peak ELO dans `🪙・auto-rôles`, créateur de salon vocal opérationnel (création dans 🍻・TAVERNE)."]
+    if failed:
+        text += [f"⚠️ {len(failed)} opération(s) en échec ou sautée(s) :"] + [f"• {d}" for d in failed]
+    for part in chunk_lines(text):
+        await inter.followup.send(part, ephemeral=True)
 
 @bot.tree.command(description="Publier un party code dans le salon-partie choisi.")
-@app_commands.describe(partie="1 à 4", code="Le party code", ping_here="Ping @here ? (oui/non)")
-@app_commands.choices(partie=[app_commands.Choice(name=str(i), value=i) for i in range(1, PREP_PAIRS+1)])
-async def party_code(inter:discord.Interaction, partie:app_commands.Choice[int], code:str, ping_here:Optional[str]="non"):
+@app_commands.describe(partie="Numéro de la partie (salon-partie-N)", code="Le party code", ping_here="Ping @here ? (oui/non)")
+async def party_code(inter:discord.Interaction, partie:app_commands.Range[int, 1, PREP_SETS_MAX], code:str, ping_here:Optional[str]="non"):
     roles = {r.name.lower() for r in inter.user.roles}
     if 'orga pp' not in roles and not inter.user.guild_permissions.administrator:
         return await inter.response.send_message("Commande réservée aux **Orga PP** / Admin.", ephemeral=True)
-    ch = get_party_text_channel(inter.guild, partie.value)
+    ch = get_party_text_channel(inter.guild, partie)
     if not ch: return await inter.response.send_message("salon-partie introuvable.", ephemeral=True)
-    embed = discord.Embed(title=f"🎮 Party Code — Partie {partie.value}", description=f"**Code :** `{code}`\nSalon associé : **Préparation {partie.value}**", color=0x2ecc71)
+    embed = discord.Embed(title=f"🎮 Party Code — Partie {partie}", description=f"**Code :** `{code}`\nSalon associé : **Préparation {partie}**", color=0x2ecc71)
     await ch.send(content="@here" if (ping_here or "").lower().startswith("o") else None, embed=embed)
-    try: await ch.edit(topic=f"Party code actuel: {code} (partie {partie.value})")
-    except: pass
+    try: await ch.edit(topic=f"Party code actuel: {code} (partie {partie})")
+    except Exception: metrics.swallowed()
     await inter.response.send_message(f"✅ Code posté dans {ch.mention}", ephemeral=True)
 
 @bot.tree.command(description="(Re)poser la roulette map dans chaque salon-partie existant.")
@@ -1190,7 +2667,7 @@ async def map_seed(interaction: discord.Interaction):
     await interaction.response.defer(ephemeral=True, thinking=True)
     g = interaction.guild
     ok, miss = [], []
-    for i in range(1, PREP_PAIRS + 1):
+    for i in set_numbers(g) or range(1, PREP_SETS_MIN + 1):
         chat = get_party_text_channel(g, i)
         if not chat:
             miss.append(i); 
@@ -1218,11 +2695,7 @@ async def set_rank(inter:discord.Interaction, valeur:str):
 @app_commands.describe(membre="Laisser vide pour toi-même.")
 async def rank_show(inter:discord.Interaction, membre:Optional[discord.Member]=None):
     m=membre or inter.user
-    best=None; bestv=-1
-    for r in m.roles:
-        if is_rank_role_name(r.name):
-            v=rank_value(r.name)
-            if v>bestv: best,bestv=r.name,v
+    _, best = peak_rank(m)
     if best is None:
         return await inter.response.send_message(f"{m.mention} n'a pas encore de peak ELO.", ephemeral=True)
     await inter.response.send_message(f"Peak ELO de {m.mention} : **{best}**", ephemeral=True)
@@ -1235,11 +2708,6 @@ async def roulette(inter:discord.Interaction):
 # ===================== Run =====================
 def main():
     if not TOKEN: raise RuntimeError("DISCORD_BOT_TOKEN manquant (.env)")
-    try:
-        from keep_alive import keep_alive
-        keep_alive()
-    except Exception as e:
-        print(f"[keep_alive] disabled: {e}")
     bot.run(TOKEN)
 
 if __name__ == "__main__":
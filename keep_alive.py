@@ -1,25 +1,63 @@
 # keep_alive.py
-from flask import Flask
-from threading import Thread
-import os, logging
+"""Petit serveur HTTP (aiohttp) sur la boucle du bot : /, /health, /metrics.
 
-logging.getLogger("werkzeug").setLevel(logging.ERROR)
-app = Flask(__name__)
+Tourne dans la même boucle asyncio que discord.py (pas de thread, pas de Flask) :
+si la boucle est bloquée, /health ne répond plus — c'est justement ce qu'on veut voir.
+"""
+import os
+import time
+from typing import Optional
 
-@app.get("/")
-def root():
-    return "OK", 200
+from aiohttp import web
 
-@app.get("/health")
-def health():
-    return {"status": "ok"}, 200
+import metrics
 
-def _run():
+HEALTH_MAX_LAG_S = float(os.getenv("HEALTH_MAX_LAG_S", "2.0"))   # au-delà : 503
+
+def _health(client) -> dict:
+    ws = getattr(client, "ws", None)
+    connected = bool(ws is not None and ws.open and not client.is_closed())
+    latency = client.latency if connected else None
+    latency = latency if latency is not None and latency == latency else None   # NaN avant le 1er heartbeat
+    wd = metrics.watchdog
+    stale = time.monotonic() - wd.beat > max(HEALTH_MAX_LAG_S, 2 * wd.tick)
+    ok = connected and client.is_ready() and wd.lag <= HEALTH_MAX_LAG_S and not stale
+    return {
+        "status": "ok" if ok else "degraded",
+        "gateway_connected": connected,
+        "ready": client.is_ready(),
+        "heartbeat_latency_ms": None if latency is None else round(latency * 1000, 1),
+        "loop_lag_ms": round(wd.lag * 1000, 1),
+        "loop_lag_max_ms": round(wd.max_lag * 1000, 1),
+        "guilds": len(client.guilds),
+    }
+
+def build_app(client) -> web.Application:
+    async def root(_):
+        return web.Response(text="OK")
+
+    async def health(_):
+        body = _health(client)
+        return web.json_response(body, status=200 if body["status"] == "ok" else 503)
+
+    async def prometheus(_):
+        return web.Response(text=metrics.render(), content_type="text/plain",
+                            headers={"X-Content-Type-Options": "nosniff"})
+
+    app = web.Application()
+    app.router.add_get("/", root)
+    app.router.add_get("/health", health)
+    app.router.add_get("/metrics", prometheus)
+    return app
+
+async def keep_alive(client) -> Optional[web.AppRunner]:
+    """Démarre le serveur si PORT est défini (Render) ; renvoie le runner à fermer à l'arrêt."""
     port_env = os.environ.get("PORT")
     if not port_env:
         # Pas sur Render: ne rien lancer (pour le local)
-        return
-    app.run(host="0.0.0.0", port=int(port_env))
-
-def keep_alive():
-    Thread(target=_run, daemon=True).start()
+        return None
+    metrics.watchdog.start()
+    runner = web.AppRunner(build_app(client), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host="0.0.0.0", port=int(port_env)).start()
+    return runner
@@ -0,0 +1,258 @@
+# metrics.py
+"""Compteurs / histogrammes en mémoire, exposés au format texte Prometheus (/metrics).
+
+Écritures et lecture (/metrics, servi par keep_alive sur la même boucle) depuis un seul
+thread : pas de verrou, juste des incréments de dict/liste.
+"""
+import io
+import os
+import sys
+import time
+import asyncio
+import functools
+import threading
+import traceback
+from bisect import bisect_left
+from collections import deque
+from typing import Dict, List, Tuple, Optional
+
+import aiohttp
+
+# Bornes (secondes) des histogrammes de latence
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts: List[int] = [0] * (len(BUCKETS) + 1)   # dernier = +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, v: float):
+        self.counts[bisect_left(BUCKETS, v)] += 1
+        self.sum += v
+        self.count += 1
+
+counters: Dict[Tuple[str, Labels], float] = {}
+histograms: Dict[Tuple[str, Labels], Histogram] = {}
+HELP = {
+    "interaction_seconds": "Durée de traitement des callbacks d'interaction",
+    "app_command_seconds": "Durée de traitement des commandes slash (checks et callback, erreurs comprises)",
+    "app_command_errors_total": "Commandes slash terminées en erreur",
+    "discord_http_requests_total": "Requêtes HTTP vers l'API Discord",
+    "discord_http_429_total": "Réponses 429 (rate limit) de l'API Discord",
+    "event_loop_lag_seconds": "Retard de planification de la boucle asyncio",
+    "event_loop_blocked_total": "Blocages de la boucle au-delà de LOOP_BLOCK_THRESHOLD_S",
+    "slow_callbacks_total": "Callbacks d'interaction au-delà de SLOW_CALLBACK_S",
+    "swallowed_exceptions_total": "Exceptions avalées (except ...: pass)",
+}
+
+def _key(name: str, labels: dict) -> Tuple[str, Labels]:
+    items = tuple(labels.items())
+    return (name, items if len(items) < 2 else tuple(sorted(items)))
+
+def inc(name: str, n: float = 1, **labels: str):
+    key = _key(name, labels)
+    counters[key] = counters.get(key, 0) + n
+
+def observe(name: str, value: float, **labels: str):
+    key = _key(name, labels)
+    h = histograms.get(key)
+    if h is None:
+        h = histograms[key] = Histogram()
+    h.observe(value)
+
+def swallowed(where: str = ""):
+    """À appeler dans un except silencieux ; étiqueté par défaut avec la fonction appelante."""
+    inc("swallowed_exceptions_total", where=where or sys._getframe(1).f_code.co_name)
+
+# ---------- Callbacks en cours / lents ----------
+SLOW_CALLBACK_S   = float(os.getenv("SLOW_CALLBACK_S", "0.5"))           # callback (await compris) jugé lent
+BLOCK_THRESHOLD_S = float(os.getenv("LOOP_BLOCK_THRESHOLD_S", "0.25"))   # boucle figée au-delà = bloquée
+WATCHDOG_TICK     = 0.1
+STACK_DEPTH       = 12
+
+class SlowEvent:
+    __slots__ = ("at", "kind", "handler", "custom_id", "duration", "stack")
+
+    def __init__(self, kind: str, handler: str, custom_id: str, duration: float, stack: str = ""):
+        self.at = time.time()
+        self.kind = kind              # "slow" (callback long) ou "blocked" (boucle figée)
+        self.handler, self.custom_id = handler, custom_id
+        self.duration, self.stack = duration, stack
+
+active: Dict[asyncio.Task, Tuple[str, str, float]] = {}   # tâche -> (handler, custom_id, début)
+active_stacks: Dict[asyncio.Task, str] = {}                # pile capturée pendant qu'un callback traîne
+
+class timer:
+    """`with metrics.timer("interaction_seconds", context=custom_id, handler="panel:join"): ...`"""
+    __slots__ = ("name", "labels", "context", "t0", "task")
+
+    def __init__(self, name: str, context: str = "", **labels: str):
+        self.name, self.labels, self.context = name, labels, context
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        task = asyncio.current_task()
+        self.task = task if task is not None and task not in active else None
+        if self.task is not None:
+            active[task] = (self.labels.get("handler", self.name), self.context, self.t0)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        dt = time.perf_counter() - self.t0
+        self.labels["outcome"] = "error" if exc_type else "ok"
+        observe(self.name, dt, **self.labels)
+        if self.task is not None:
+            active.pop(self.task, None)
+            stack = active_stacks.pop(self.task, "")
+            if dt >= SLOW_CALLBACK_S:
+                handler = self.labels.get("handler", self.name)
+                inc("slow_callbacks_total", handler=handler)
+                watchdog.events.append(SlowEvent("slow", handler, self.context, dt, stack))
+                print(f"[watchdog] callback lent {dt*1000:.0f} ms ({handler} {self.context})\n{stack}", flush=True)
+        return False
+
+def timed(handler: str):
+    """Décorateur de callback async (self, interaction, ...) : mesure dans interaction_seconds{handler=...}."""
+    def deco(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            data = getattr(args[1], "data", None) if len(args) > 1 else None
+            with timer("interaction_seconds", context=(data or {}).get("custom_id", ""), handler=handler):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+class LoopWatchdog:
+    """Côté boucle : un battement toutes les WATCHDOG_TICK s mesure le retard et capture la pile
+    (await en cours) des callbacks qui dépassent SLOW_CALLBACK_S. Côté thread : si le battement
+    s'arrête plus de BLOCK_THRESHOLD_S, on capture la pile Python du thread de la boucle — donc
+    le code bloquant lui-même — avec le custom_id de l'interaction en cours."""
+
+    def __init__(self, tick: float = WATCHDOG_TICK, block_after: float = BLOCK_THRESHOLD_S, keep: int = 200):
+        self.tick, self.block_after = tick, block_after
+        self.lag = 0.0          # dernier retard mesuré (s)
+        self.max_lag = 0.0      # pire retard depuis le démarrage
+        self.beat = time.monotonic()
+        self.events: deque = deque(maxlen=keep)   # SlowEvent, append thread-safe
+        self.task: Optional[asyncio.Task] = None
+        self.thread: Optional[threading.Thread] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread = 0
+        self._last_block: Optional[SlowEvent] = None
+
+    def start(self):
+        if self.task is not None and not self.task.done():
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self.beat = time.monotonic()
+        self.task = asyncio.create_task(self._beat())
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+            self.thread.start()
+
+    async def _beat(self):
+        loop = self._loop
+        while True:
+            t0 = loop.time()
+            await asyncio.sleep(self.tick)
+            self.lag = max(0.0, loop.time() - t0 - self.tick)
+            self.max_lag = max(self.max_lag, self.lag)
+            self.beat = time.monotonic()
+            observe("event_loop_lag_seconds", self.lag)
+            if self.lag >= self.block_after:
+                inc("event_loop_blocked_total")
+                ev, self._last_block = self._last_block, None
+                if ev is not None:
+                    ev.duration = max(ev.duration, self.lag)   # durée réelle connue au réveil
+            if active:
+                self._sample_active()
+
+    def _sample_active(self):
+        now = time.perf_counter()
+        for task, (_, _, t0) in list(active.items()):
+            if now - t0 >= SLOW_CALLBACK_S and task not in active_stacks:
+                buf = io.StringIO()
+                task.print_stack(limit=STACK_DEPTH, file=buf)
+                active_stacks[task] = buf.getvalue()
+
+    def _watch(self):
+        reported = 0.0
+        while True:
+            time.sleep(self.tick / 2)
+            beat = self.beat
+            stalled = time.monotonic() - beat
+            if stalled < self.block_after or beat == reported:
+                continue
+            reported = beat
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            stack = "".join(traceback.format_stack(frame, limit=STACK_DEPTH))
+            del frame
+            handler, cid, _ = active.get(asyncio.current_task(self._loop), ("—", "", 0.0))
+            ev = SlowEvent("blocked", handler, cid, stalled, stack)
+            self._last_block = ev
+            self.events.append(ev)
+            print(f"[watchdog] boucle bloquée ≥{stalled*1000:.0f} ms ({handler} {cid})\n{stack}", flush=True)
+
+watchdog = LoopWatchdog()
+
+def http_trace() -> aiohttp.TraceConfig:
+    """Compte les appels REST de discord.py (passé à Client(http_trace=...))."""
+    async def on_request_end(session, ctx, params):
+        status = params.response.status
+        inc("discord_http_requests_total", method=params.method, status=str(status))
+        if status == 429:
+            inc("discord_http_429_total")
+    async def on_request_exception(session, ctx, params):
+        inc("discord_http_requests_total", method=params.method, status="exception")
+    trace = aiohttp.TraceConfig()
+    trace.on_request_end.append(on_request_end)
+    trace.on_request_exception.append(on_request_exception)
+    return trace
+
+# ---------- Export ----------
+def _snapshot(d: dict) -> list:
+    # Copie défensive (un thread d'exécution peut incrémenter pendant le rendu) : on réessaie si le dict bouge.
+    while True:
+        try:
+            return list(d.items())
+        except RuntimeError:
+            continue
+
+def _fmt_labels(labels: Labels, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    items = labels + extra
+    if not items:
+        return ""
+    esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in items) + "}"
+
+def render() -> str:
+    out: List[str] = []
+    seen = set()
+    def header(name: str, kind: str):
+        if name not in seen:
+            seen.add(name)
+            if name in HELP:
+                out.append(f"# HELP {name} {HELP[name]}")
+            out.append(f"# TYPE {name} {kind}")
+    for (name, labels), v in sorted(_snapshot(counters)):
+        header(name, "counter")
+        out.append(f"{name}{_fmt_labels(labels)} {v:g}")
+    for (name, labels), h in sorted(_snapshot(histograms), key=lambda kv: kv[0]):
+        header(name, "histogram")
+        counts, total, n = list(h.counts), h.sum, h.count
+        acc = 0
+        for bound, c in zip(BUCKETS + (float("inf"),), counts):
+            acc += c
+            le = "+Inf" if bound == float("inf") else f"{bound:g}"
+            out.append(f"{name}_bucket{_fmt_labels(labels, (('le', le),))} {acc}")
+        out.append(f"{name}_sum{_fmt_labels(labels)} {total:.6f}")
+        out.append(f"{name}_count{_fmt_labels(labels)} {n}")
+    return "\n".join(out) + "\n"